@@ -32,3 +32,12 @@ from contract import *
 from invoice import *
 from party import *
 from configuration import *
+from company import *
+from billing import *
+from forecast import *
+from billing_queue import *
+from price_index import *
+from revenue import *
+from contract_import import *
+from usage import *
+from transition import *
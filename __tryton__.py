@@ -14,6 +14,12 @@
         'party.xml',
         'invoice.xml',
         'configuration.xml',
+        'billing.xml',
+        'forecast.xml',
+        'price_index.xml',
+        'revenue.xml',
+        'usage.xml',
+        'transition.xml',
     ],
     'depends': [
         'account',
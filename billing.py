@@ -0,0 +1,532 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from __future__ import with_statement
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.config import CONFIG
+
+import os
+import sys
+import time
+import datetime
+import threading
+import logging
+from contextlib import contextmanager
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import cProfile as profile
+except ImportError:
+    import profile
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100
+
+# a running billing run without checkpoint for this long is taken for
+# interrupted and may be resumed
+RUN_LEASE = datetime.timedelta(hours=1)
+
+
+def run_in_chunks(ids, function, chunk_size=None, commit=True):
+    """
+    Call function with the ids in chunks of chunk_size ids, committing
+    after each chunk when commit is set.
+
+    Each chunk runs inside a savepoint. When a chunk fails it is rolled
+    back and replayed id by id, so only the failing ids are left out and
+    the run goes on.
+
+    returns a dict with the 'total', 'done' and 'failed' counts, the
+    number of 'chunks', the 'elapsed' seconds and the 'errors' per id
+    """
+    cursor = Transaction().cursor
+    chunk_size = chunk_size or CHUNK_SIZE
+    res = {
+        'total': len(ids),
+        'done': 0,
+        'failed': 0,
+        'chunks': 0,
+        'elapsed': 0.0,
+        'errors': {},
+    }
+    start = time.time()
+    for i in range(0, len(ids), chunk_size):
+        sub_ids = ids[i:i + chunk_size]
+        cursor.execute('SAVEPOINT contract_chunk')
+        try:
+            function(sub_ids)
+            done = len(sub_ids)
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT contract_chunk')
+            done = 0
+            for record_id in sub_ids:
+                cursor.execute('SAVEPOINT contract_record')
+                try:
+                    function([record_id])
+                except Exception:
+                    cursor.execute('ROLLBACK TO SAVEPOINT contract_record')
+                    res['errors'][record_id] = str(sys.exc_info()[1])
+                    continue
+                cursor.execute('RELEASE SAVEPOINT contract_record')
+                done += 1
+        cursor.execute('RELEASE SAVEPOINT contract_chunk')
+        if commit:
+            cursor.commit()
+
+        res['done'] += done
+        res['failed'] = len(res['errors'])
+        res['chunks'] += 1
+        res['elapsed'] = time.time() - start
+        log.info('processed %d/%d (%d failed) in %.1fs',
+                 res['done'] + res['failed'], res['total'], res['failed'],
+                 res['elapsed'])
+    return res
+
+
+class BillingCache(object):
+    """
+    Memoize the product accounts, product taxes and tax rule results used
+    to build invoice lines.
+
+    An instance lives for one batch run. All instances are invalidated
+    when products, taxes or tax rules are created, written or deleted.
+    """
+    generation = 0
+
+    def __init__(self):
+        self._generation = BillingCache.generation
+        self._values = {}
+        self.hits = {}
+        self.misses = {}
+
+    def invalidate(cls):
+        cls.generation += 1
+    invalidate = classmethod(invalidate)
+
+    def get(self, key, compute):
+        """
+        returns the value cached for key, calling compute() on a miss
+
+        key is a tuple whose first item names the kind of value, the
+        hit and miss counters are kept per kind.
+        """
+        if self._generation != BillingCache.generation:
+            self._values.clear()
+            self._generation = BillingCache.generation
+
+        kind = key[0]
+        if key in self._values:
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            return self._values[key]
+        self.misses[kind] = self.misses.get(kind, 0) + 1
+        value = compute()
+        self._values[key] = value
+        return value
+
+    def account(self, product_obj, product_id, company_id):
+        return self.get(('account', product_id, company_id),
+            lambda: product_obj.get_account([product_id],
+                'account_revenue_used').get(product_id))
+
+    def taxes(self, product_obj, product_id, company_id):
+        return self.get(('taxes', product_id, company_id),
+            lambda: product_obj.get_taxes([product_id],
+                'customer_taxes_used')[product_id])
+
+    def tax_rule(self, tax_rule_obj, rule_id, tax_id):
+        return self.get(('tax_rule', rule_id, tax_id),
+            lambda: tax_rule_obj.apply(rule_id, tax_id, {}))
+
+    def stats(self):
+        """
+        returns a dict mapping each kind to a (hits, misses) tuple
+        """
+        res = {}
+        for kind in set(self.hits.keys() + self.misses.keys()):
+            res[kind] = (self.hits.get(kind, 0), self.misses.get(kind, 0))
+        return res
+
+
+class BillingStats(object):
+    """
+    Wall time and call counts per phase of a batch run, the number of
+    contracts skipped per reason and other counters.
+
+    The phases are 'search', 'load', 'check', 'init', 'append', 'tax'
+    and 'write'; 'tax' is spent inside 'append'.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.skipped = {}
+        self.counts = {}
+
+    def measure(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[phase] = self.seconds.get(phase, 0.0) \
+                    + time.time() - start
+            self.calls[phase] = self.calls.get(phase, 0) + 1
+    measure = contextmanager(measure)
+
+    def skip(self, reason, count=1):
+        self.skipped[reason] = self.skipped.get(reason, 0) + count
+
+    def count(self, name, count=1):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def summary(self):
+        """
+        returns a dict with the 'phases' mapping each phase to its 'calls'
+        and 'seconds', and the 'skipped' and 'counts' dicts
+        """
+        phases = {}
+        for phase in self.calls:
+            phases[phase] = {
+                'calls': self.calls[phase],
+                'seconds': self.seconds[phase],
+            }
+        return {
+            'phases': phases,
+            'skipped': self.skipped.copy(),
+            'counts': self.counts.copy(),
+        }
+
+    def update(self, summary):
+        """
+        Add a summary, e.g. from another process, to these statistics
+        """
+        for phase, values in summary['phases'].items():
+            self.seconds[phase] = self.seconds.get(phase, 0.0) \
+                    + values['seconds']
+            self.calls[phase] = self.calls.get(phase, 0) + values['calls']
+        for reason, count in summary['skipped'].items():
+            self.skip(reason, count)
+        for name, count in summary['counts'].items():
+            self.count(name, count)
+
+    def dumps(self):
+        return json.dumps(self.summary(), sort_keys=True)
+
+
+def run_profiled(function, *args, **kwargs):
+    """
+    Call function, under cProfile when 'billing_profile' is set in the
+    context and the billing_profile_path option of the server
+    configuration names the directory to dump the profiles to.
+
+    The context only switches profiling on: the file name is built here,
+    from the database, the function and the time, so clients can not
+    choose where the profile is written.
+    """
+    directory = CONFIG.get('billing_profile_path')
+    if not Transaction().context.get('billing_profile') or not directory:
+        return function(*args, **kwargs)
+    now = datetime.datetime.now()
+    filename = os.path.join(directory, '%s-%s-%s%06d.prof' % (
+        Transaction().cursor.database_name, function.__name__.strip('_'),
+        now.strftime('%Y%m%d%H%M%S'), now.microsecond))
+    profiler = profile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(filename)
+        log.info('billing profile written to %s', filename)
+
+
+class Snapshot(object):
+    """
+    Read-only copy of the values of a record needed for billing, built
+    from the dict returned by read(). Many2One fields hold ids, except
+    where a loader replaces them by the snapshot of the target record.
+    """
+    __slots__ = ()
+
+    def __init__(self, values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.id)
+
+
+class CompanySnapshot(Snapshot):
+    __slots__ = ('id', 'currency')
+
+
+class PartySnapshot(Snapshot):
+    __slots__ = ('id', 'name', 'customer_tax_rule', 'account_receivable',
+                 'payment_term', 'invoice_address')
+
+
+class ProductSnapshot(Snapshot):
+    __slots__ = ('id', 'name', 'list_price', 'default_uom')
+
+
+class ContractSnapshot(Snapshot):
+    __slots__ = ('id', 'name', 'reference', 'state', 'company', 'journal',
+                 'party', 'product', 'payment_term', 'list_price', 'discount',
+                 'quantity', 'interval', 'interval_quant',
+                 'next_invoice_date', 'start_date', 'stop_date', 'metered')
+
+
+def _run_worker(database_name, user, context, run_id):
+    """
+    Process the queued billing run run_id in its own transaction, meant to
+    be the target of a worker thread
+    """
+    with Transaction().start(database_name, user, context=context):
+        run_obj = Pool(database_name).get('contract.billing.run')
+        # a failing run is logged and marked as failed by process
+        run_obj.process([run_id])
+
+
+class BillingCacheInvalidate(object):
+    """
+    Mixin invalidating the billing caches whenever records of the model
+    are created, written or deleted.
+    """
+
+    def create(self, vals):
+        BillingCache.invalidate()
+        return super(BillingCacheInvalidate, self).create(vals)
+
+    def write(self, ids, vals):
+        BillingCache.invalidate()
+        return super(BillingCacheInvalidate, self).write(ids, vals)
+
+    def delete(self, ids):
+        BillingCache.invalidate()
+        return super(BillingCacheInvalidate, self).delete(ids)
+
+
+class Product(BillingCacheInvalidate, ModelSQL, ModelView):
+    _name = 'product.product'
+
+Product()
+
+
+class Template(BillingCacheInvalidate, ModelSQL, ModelView):
+    _name = 'product.template'
+
+Template()
+
+
+class Tax(BillingCacheInvalidate, ModelSQL, ModelView):
+    _name = 'account.tax'
+
+Tax()
+
+
+class TaxRule(BillingCacheInvalidate, ModelSQL, ModelView):
+    _name = 'account.tax.rule'
+
+TaxRule()
+
+
+class TaxRuleLine(BillingCacheInvalidate, ModelSQL, ModelView):
+    _name = 'account.tax.rule.line'
+
+TaxRuleLine()
+
+
+class BillingRun(ModelSQL, ModelView):
+    'Contract Billing Run'
+    _name = 'contract.billing.run'
+    _description = __doc__
+
+    invoice_date = fields.Date('Invoice Date', required=True, readonly=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True)
+    chunk_size = fields.Integer('Chunk Size', readonly=True,
+                                help='Number of parties billed per commit')
+    last_party = fields.Many2One('party.party', 'Last Party', readonly=True,
+                                 help='Checkpoint: last party that was '
+                                 'completely billed')
+    party_count = fields.Integer('Parties', readonly=True)
+    party_total = fields.Integer('Parties to Bill', readonly=True)
+    invoice_count = fields.Integer('Invoices', readonly=True)
+    contracts = fields.Many2Many('contract.billing.run-contract.contract',
+                                 'run', 'contract', 'Contracts', readonly=True,
+                                 help='Bill only these contracts, all due '
+                                 'contracts when empty')
+    invoices = fields.Many2Many('contract.billing.run-account.invoice',
+                                'run', 'invoice', 'Invoices', readonly=True)
+    error = fields.Text('Error', readonly=True)
+    stats = fields.Text('Statistics', readonly=True,
+                        help='Time and calls per phase and skipped '
+                        'contracts per reason, as JSON')
+
+    def __init__(self):
+        super(BillingRun, self).__init__()
+        self._order.insert(0, ('id', 'DESC'))
+        self._rpc.update({
+            'resume': True,
+            'get_status': False,
+        })
+
+    def default_state(self):
+        return 'running'
+
+    def default_chunk_size(self):
+        return CHUNK_SIZE
+
+    def default_party_count(self):
+        return 0
+
+    def default_party_total(self):
+        return 0
+
+    def default_invoice_count(self):
+        return 0
+
+    def resume(self, ids):
+        """
+        Resume interrupted runs from their checkpoint: failed runs and
+        running runs whose worker stopped checkpointing for RUN_LEASE.
+        Runs that are being processed are left alone.
+        """
+        contract_obj = self.pool.get('contract.contract')
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        for run_id in ids:
+            contract_obj.create_invoice_batch_chunked(run_id=run_id)
+        return {}
+
+    def claim(self, run_id):
+        """
+        Move the run run_id to running with a conditional UPDATE, when it
+        is queued, failed or running without checkpoint for RUN_LEASE, so
+        only one worker processes a run at a time. The caller commits.
+
+        returns True when the run was claimed
+        """
+        cursor = Transaction().cursor
+        now = datetime.datetime.now()
+        cursor.execute('UPDATE "' + self._table + '" '
+            'SET state = %s, write_uid = %s, write_date = %s '
+            'WHERE id = %s AND (state IN (%s, %s) '
+                'OR (state = %s '
+                    'AND COALESCE(write_date, create_date) < %s))',
+            ('running', Transaction().user, now, run_id, 'queued', 'failed',
+                'running', now - RUN_LEASE))
+        return bool(cursor.rowcount)
+
+    def enqueue(self, invoice_date=None, contract_ids=None, chunk_size=None,
+            worker=True):
+        """
+        Queue a billing run at invoice_date, limited to contract_ids when
+        given, and commit it so a worker can pick it up.
+
+        With worker set, a worker thread is started to process it right
+        away, except on an in-memory database that other connections can
+        not see. Queued runs left behind are processed by the cron.
+
+        returns the id of the queued run
+        """
+        cursor = Transaction().cursor
+        values = {
+            'invoice_date': invoice_date or datetime.date.today(),
+            'chunk_size': chunk_size or CHUNK_SIZE,
+            'state': 'queued',
+        }
+        if contract_ids:
+            values['contracts'] = [('set', contract_ids)]
+        run_id = self.create(values)
+        cursor.commit()
+
+        if worker and cursor.database_name != ':memory:':
+            thread = threading.Thread(target=_run_worker,
+                args=(cursor.database_name, Transaction().user,
+                      Transaction().context.copy(), run_id))
+            thread.setDaemon(True)
+            thread.start()
+        log.info('billing run %s queued', run_id)
+        return run_id
+
+    def process(self, ids):
+        """
+        Bill the queued runs in ids. Each run is claimed first, so a run
+        picked up by both the worker and the cron is billed only once.
+        A run that fails is logged and marked as failed with its error,
+        and the next runs are still processed.
+
+        returns the list of the ids of the failed runs
+        """
+        contract_obj = self.pool.get('contract.contract')
+        cursor = Transaction().cursor
+        failed = []
+        for run_id in ids:
+            try:
+                contract_obj.create_invoice_batch_chunked(run_id=run_id)
+            except Exception:
+                error = str(sys.exc_info()[1])
+                log.exception('billing run %s failed', run_id)
+                cursor.rollback()
+                self.write(run_id, {
+                    'state': 'failed',
+                    'error': error,
+                })
+                cursor.commit()
+                failed.append(run_id)
+        return failed
+
+    def process_queued(self):
+        """
+        Process all queued runs, called by the cron
+        """
+        self.process(self.search([('state', '=', 'queued')],
+                                 order=[('id', 'ASC')]))
+
+    def get_status(self, ids):
+        """
+        returns a dict mapping each run id to a dict with its 'state', the
+        'party_count' billed of 'party_total', the 'invoice_count', the
+        'invoices' ids and the 'error'
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        res = {}
+        for values in self.read(ids, ['state', 'party_count', 'party_total',
+                'invoice_count', 'invoices', 'error']):
+            res[values.pop('id')] = values
+        return res
+
+BillingRun()
+
+
+class BillingRunContract(ModelSQL):
+    'Billing Run - Contract'
+    _name = 'contract.billing.run-contract.contract'
+    _table = 'contract_billing_run_contract_rel'
+    _description = __doc__
+    run = fields.Many2One('contract.billing.run', 'Billing Run',
+                          ondelete='CASCADE', select=1, required=True)
+    contract = fields.Many2One('contract.contract', 'Contract',
+                               ondelete='CASCADE', required=True)
+
+BillingRunContract()
+
+
+class BillingRunInvoice(ModelSQL):
+    'Billing Run - Invoice'
+    _name = 'contract.billing.run-account.invoice'
+    _table = 'contract_billing_run_invoice_rel'
+    _description = __doc__
+    run = fields.Many2One('contract.billing.run', 'Billing Run',
+                          ondelete='CASCADE', select=1, required=True)
+    invoice = fields.Many2One('account.invoice', 'Invoice',
+                              ondelete='CASCADE', required=True)
+
+BillingRunInvoice()
@@ -0,0 +1,261 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.backend import TableHandler
+from trytond.tools import reduce_ids
+from contract import NOTICE_DAYS, billing_period, add_intervals
+
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+# contract fields the queue entry of a contract depends on
+QUEUE_FIELDS = [
+    'party',
+    'state',
+    'interval',
+    'interval_quant',
+    'start_date',
+    'next_invoice_date',
+    'stop_date',
+    'metered',
+]
+
+
+def queue_dates(state, interval, interval_quant, start_date,
+        next_invoice_date, stop_date, metered=False):
+    """
+    returns the (due_date, next_period_end) tuple of a contract or None
+    when the contract will not be billed anymore
+
+    due_date is the first invoice date at which _check_contract bills the
+    contract and next_period_end the end of the period billed at that date.
+    A metered contract is billed in arrears: it is due once its period is
+    over, or at its stop_date for the last period, which ends there.
+    """
+    if state != 'active' or not start_date:
+        return None
+    last_date = next_invoice_date or start_date
+    if metered:
+        if stop_date and last_date >= stop_date:
+            return None
+        next_period_end = add_intervals(interval, last_date,
+                                        interval_quant or 1)
+        if stop_date and next_period_end > stop_date:
+            next_period_end = stop_date
+        return (next_period_end, next_period_end)
+    due_date = max(start_date, last_date
+        - datetime.timedelta(NOTICE_DAYS) + datetime.timedelta(1))
+    next_period_end, quant = billing_period(interval, interval_quant,
+        last_date, due_date + datetime.timedelta(NOTICE_DAYS))
+    if not quant:
+        return None
+    if stop_date and next_period_end > stop_date:
+        return None
+    return (due_date, next_period_end)
+
+
+class BillingQueue(ModelSQL):
+    'Contract Billing Queue'
+    _name = 'contract.billing_queue'
+    _description = __doc__
+
+    contract = fields.Many2One('contract.contract', 'Contract', required=True,
+                               select=1, ondelete='CASCADE')
+    party = fields.Many2One('party.party', 'Party', required=True, select=1)
+    due_date = fields.Date('Due Date', required=True, select=1)
+    next_period_end = fields.Date('Next Period End', required=True)
+
+    def init(self, module_name):
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, self._table)
+        super(BillingQueue, self).init(module_name)
+
+        # Fill the queue for the contracts of an existing database
+        if created:
+            self.rebuild()
+
+    def sync(self, contract_ids):
+        """
+        Replace the queue entries of the contracts in contract_ids by their
+        current due date, reading the contracts with plain SQL
+        """
+        cursor = Transaction().cursor
+        contract_obj = self.pool.get('contract.contract')
+        now = datetime.datetime.now()
+
+        for i in range(0, len(contract_ids), cursor.IN_MAX):
+            sub_ids = contract_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('contract', sub_ids)
+            cursor.execute('DELETE FROM "' + self._table + '" '
+                'WHERE ' + red_sql, red_ids)
+
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute('SELECT id, ' + ', '.join(['"%s"' % x
+                    for x in QUEUE_FIELDS]) + ' '
+                'FROM "' + contract_obj._table + '" '
+                'WHERE ' + red_sql, red_ids)
+            for row in cursor.fetchall():
+                contract_id, party_id = row[:2]
+                dates = queue_dates(*row[2:])
+                if not dates:
+                    continue
+                cursor.execute('INSERT INTO "' + self._table + '" '
+                    '(create_uid, create_date, contract, party, due_date, '
+                        'next_period_end) '
+                    'VALUES (%s, %s, %s, %s, %s, %s)',
+                    (Transaction().user, now, contract_id, party_id)
+                    + dates)
+
+    def rebuild(self):
+        """
+        Recompute the whole queue from the active contracts
+        """
+        cursor = Transaction().cursor
+        contract_obj = self.pool.get('contract.contract')
+
+        cursor.execute('DELETE FROM "' + self._table + '"')
+        cursor.execute('SELECT id FROM "' + contract_obj._table + '" '
+            'WHERE state = %s', ('active',))
+        self.sync([x[0] for x in cursor.fetchall()])
+
+    def verify(self, invoice_date=None):
+        """
+        Check the queue against the contracts.
+
+        Each entry must match queue_dates of its contract, each contract
+        with due dates must have an entry, and the contracts that
+        _due_domain selects and _check_contracts accepts at invoice_date
+        (today by default) must be due in the queue.
+
+        returns the sorted ids of the contracts whose entry is missing,
+        stale or superfluous; rebuild fixes them
+        """
+        cursor = Transaction().cursor
+        contract_obj = self.pool.get('contract.contract')
+        invoice_date = invoice_date or datetime.date.today()
+
+        expected = {}
+        cursor.execute('SELECT id, ' + ', '.join(['"%s"' % x
+                for x in QUEUE_FIELDS]) + ' '
+            'FROM "' + contract_obj._table + '"')
+        for row in cursor.fetchall():
+            dates = queue_dates(*row[2:])
+            if dates:
+                expected[row[0]] = (row[1],) + dates
+
+        res = set()
+        cursor.execute('SELECT contract, party, due_date, next_period_end '
+            'FROM "' + self._table + '"')
+        found = {}
+        for row in cursor.fetchall():
+            if row[0] in found:
+                res.add(row[0])
+            found[row[0]] = tuple(row[1:])
+        for contract_id in set(expected) | set(found):
+            if expected.get(contract_id) != found.get(contract_id):
+                res.add(contract_id)
+
+        due = set([x[0] for x in self.due(invoice_date)])
+        contract_ids = contract_obj.search(
+            contract_obj._due_domain(invoice_date))
+        periods = contract_obj._check_contracts(
+            contract_obj._read_snapshots(contract_ids), invoice_date)
+        res.update([x for x, period in periods.items()
+            if period and period[2] and x not in due])
+
+        if res:
+            log.warning('billing queue out of sync for contracts %s',
+                        sorted(res))
+        return sorted(res)
+
+    def due(self, invoice_date, party=None, after_party=None):
+        """
+        returns the (contract id, party id) tuples of the contracts due at
+        invoice_date, sorted on party and contract, optionally limited to
+        party (an id or a list of ids) and to the parties after after_party
+        """
+        cursor = Transaction().cursor
+
+        sql = 'SELECT contract, party FROM "' + self._table + '" ' \
+                'WHERE due_date <= %s'
+        args = [invoice_date]
+        if after_party:
+            sql += ' AND party > %s'
+            args.append(after_party)
+        if party:
+            if not isinstance(party, list):
+                party = [party]
+            red_sql, red_ids = reduce_ids('party', party)
+            sql += ' AND ' + red_sql
+            args.extend(red_ids)
+        cursor.execute(sql + ' ORDER BY party, contract', args)
+        return cursor.fetchall()
+
+BillingQueue()
+
+
+class Contract(ModelSQL, ModelView):
+    _name = 'contract.contract'
+
+    def create(self, vals):
+        queue_obj = self.pool.get('contract.billing_queue')
+        res = super(Contract, self).create(vals)
+        queue_obj.sync([res])
+        return res
+
+    def write(self, ids, vals):
+        queue_obj = self.pool.get('contract.billing_queue')
+        res = super(Contract, self).write(ids, vals)
+        if [x for x in QUEUE_FIELDS if x in vals]:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            queue_obj.sync(ids)
+        return res
+
+    def _write_billing_dates(self, name, dates):
+        queue_obj = self.pool.get('contract.billing_queue')
+        super(Contract, self)._write_billing_dates(name, dates)
+        if name in QUEUE_FIELDS:
+            queue_obj.sync(list(dates))
+
+    def delete(self, ids):
+        queue_obj = self.pool.get('contract.billing_queue')
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        queue_obj.delete(queue_obj.search([('contract', 'in', ids)]))
+        return super(Contract, self).delete(ids)
+
+    def _search_due_contracts(self, invoice_date, party=None, domain=None):
+        """
+        returns the ids of the contracts due at invoice_date from the
+        billing queue instead of a search on _due_domain, optionally
+        limited to party and to the extra domain clauses in domain
+        """
+        cursor = Transaction().cursor
+        queue_obj = self.pool.get('contract.billing_queue')
+
+        contract_ids = [x[0] for x in queue_obj.due(invoice_date,
+                                                    party=party)]
+        if not domain:
+            return contract_ids
+
+        res = []
+        for i in range(0, len(contract_ids), cursor.IN_MAX):
+            sub_ids = contract_ids[i:i + cursor.IN_MAX]
+            res.extend(self.search([('id', 'in', sub_ids)] + domain))
+        return res
+
+    def _due_contracts_by_party(self, invoice_date, party=None,
+            after_party=None):
+        queue_obj = self.pool.get('contract.billing_queue')
+
+        by_party = {}
+        for contract_id, party_id in queue_obj.due(invoice_date, party=party,
+                after_party=after_party):
+            by_party.setdefault(party_id, []).append(contract_id)
+        return sorted(by_party.items())
+
+Contract()
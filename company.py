@@ -0,0 +1,48 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from trytond.model import ModelView, ModelSQL
+from trytond.cache import Cache
+
+import logging
+log = logging.getLogger(__name__)
+
+class Company(ModelSQL, ModelView):
+    'Company'
+    _name = 'company.company'
+
+    def create(self, vals):
+        res = super(Company, self).create(vals)
+        self.get_contract_defaults.reset()
+        return res
+
+    def write(self, ids, vals):
+        res = super(Company, self).write(ids, vals)
+        self.get_contract_defaults.reset()
+        return res
+
+    def delete(self, ids):
+        res = super(Company, self).delete(ids)
+        self.get_contract_defaults.reset()
+        return res
+
+    @Cache('company_company.get_contract_defaults')
+    def get_contract_defaults(self, company_id):
+        """
+        returns a dict with the currency, account_receivable and
+        payment_term ids of the company, used on contracts and their
+        invoices
+        """
+        res = {
+            'currency': False,
+            'account_receivable': False,
+            'payment_term': False,
+        }
+        if not company_id:
+            return res
+        company = self.browse(company_id)
+        for field in res:
+            if company[field]:
+                res[field] = company[field].id
+        return res
+
+Company()
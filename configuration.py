@@ -1,6 +1,7 @@
 #This file is part of Tryton.  The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.                                                                                                                
 from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
+from trytond.cache import Cache
   
 import logging
 log = logging.getLogger(__name__)
@@ -20,4 +21,31 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
     def default_description(self):
         return 'Contract Invoice'
 
+    def create(self, vals):
+        res = super(Configuration, self).create(vals)
+        self.get_defaults.reset()
+        return res
+
+    def write(self, ids, vals):
+        res = super(Configuration, self).write(ids, vals)
+        self.get_defaults.reset()
+        return res
+
+    def delete(self, ids):
+        res = super(Configuration, self).delete(ids)
+        self.get_defaults.reset()
+        return res
+
+    @Cache('contract_configuration.get_defaults')
+    def get_defaults(self):
+        """
+        returns a dict with the configured description and payment_term id
+        """
+        config = self.browse(1)
+        return {
+            'description': config.description,
+            'payment_term': config.payment_term and config.payment_term.id \
+                    or False,
+        }
+
 Configuration()
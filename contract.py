@@ -5,11 +5,27 @@ from trytond.model import ModelView, ModelSQL, ModelWorkflow, fields
 from trytond.wizard import Wizard
 from trytond.pyson import Eval, Not, If, In, Get
 from trytond.transaction import Transaction
+from trytond.backend import TableHandler
+from trytond.config import CONFIG
+from trytond.pool import Pool
+from trytond.tools import reduce_ids
+from billing import BillingCache, BillingStats, CHUNK_SIZE, run_profiled, \
+        ContractSnapshot, PartySnapshot, ProductSnapshot, CompanySnapshot
 
 import datetime
 from dateutil.relativedelta import relativedelta
 import time
+import sys
+import threading
 import logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 log = logging.getLogger(__name__)
 
@@ -20,6 +36,155 @@ STATES = {
 
 NOTICE_DAYS = 1
 
+def billing_period(interval, interval_quant, last_date, end):
+    """
+    returns tuple (next_date, count)
+
+    next_date is the first period boundary on or after end, stepping
+    interval_quant intervals at a time from last_date. count is the number
+    of intervals (days, weeks, months, years) between last_date and
+    next_date.
+
+    Month and year boundaries are always computed from last_date itself, so
+    a period starting on the 31st ends on the last day of shorter months
+    without drifting to an earlier day in the months after.
+
+    """
+    step = interval_quant or 1
+    if last_date >= end:
+        return (last_date, 0)
+
+    if interval in ('day', 'week'):
+        days = step
+        if interval == 'week':
+            days = step * 7
+        steps = ((end - last_date).days + days - 1) // days
+        next_date = last_date + datetime.timedelta(steps * days)
+        return (next_date, steps * step)
+
+    if interval == 'month':
+        months = (end.year - last_date.year) * 12 + end.month - last_date.month
+        count = months // step * step
+        next_date = last_date + relativedelta(months=count)
+        if next_date < end:
+            count += step
+            next_date = last_date + relativedelta(months=count)
+        return (next_date, count)
+
+    if interval == 'year':
+        count = (end.year - last_date.year) // step * step
+        next_date = last_date + relativedelta(years=count)
+        if next_date < end:
+            count += step
+            next_date = last_date + relativedelta(years=count)
+        return (next_date, count)
+
+    return (last_date, 0)
+
+def add_intervals(interval, date, count):
+    """
+    returns date moved count intervals (days, weeks, months, years)
+    forward, as billing_period steps from last_date
+    """
+    if interval == 'day':
+        return date + datetime.timedelta(count)
+    if interval == 'week':
+        return date + datetime.timedelta(count * 7)
+    if interval == 'month':
+        return date + relativedelta(months=count)
+    if interval == 'year':
+        return date + relativedelta(years=count)
+    return date
+
+def contract_unit_price(product_list_price, list_price, discount):
+    """
+    returns the unit price billed for a contract with the given list_price
+    override and discount on a product priced at product_list_price
+    """
+    unit_price = product_list_price
+    if list_price:
+        unit_price = list_price
+    elif discount:
+        unit_price = product_list_price - (product_list_price * discount / 100)
+    return unit_price
+
+def _billing_worker(database_name, invoice_date, parties, chunk_size,
+        threaded=False, user=None, context=None):
+    """
+    Bill the (party id, contract ids) tuples of one partition.
+
+    With threaded set, it runs as the target of a worker thread: the
+    partition is billed in a transaction of its own on database_name,
+    started for user and context, which is committed every chunk_size
+    parties; a failing chunk is rolled back and reported. Otherwise the
+    partition is billed in the current transaction.
+
+    returns a report dict with the created invoice ids, the skipped
+    contract ids, the errors and the BillingStats summary as 'stats'
+    """
+    res = {
+        'invoices': [],
+        'skipped': [],
+        'errors': [],
+    }
+    stats = BillingStats()
+
+    def bill():
+        contract_obj = Pool(database_name).get('contract.contract')
+        cursor = Transaction().cursor
+        cache = BillingCache()
+        for i in range(0, len(parties), chunk_size):
+            chunk = parties[i:i + chunk_size]
+            contract_ids = []
+            for party_id, party_contract_ids in chunk:
+                contract_ids.extend(party_contract_ids)
+            skipped = []
+            try:
+                invoice_ids = contract_obj._bill_contracts(contract_ids,
+                    invoice_date, cache=cache, skipped=skipped, stats=stats)
+                if threaded:
+                    cursor.commit()
+            except Exception:
+                if not threaded:
+                    raise
+                cursor.rollback()
+                log.exception('billing failed for parties %s',
+                              [p for p, c in chunk])
+                res['errors'].append({
+                    'parties': [p for p, c in chunk],
+                    'error': str(sys.exc_info()[1]),
+                })
+                continue
+            res['invoices'].extend(invoice_ids)
+            res['skipped'].extend(skipped)
+
+    if threaded:
+        with Transaction().start(database_name, user, context=context):
+            bill()
+    else:
+        bill()
+    res['stats'] = stats.summary()
+    return res
+
+def _billing_thread(args, reports):
+    """
+    Run _billing_worker with args in a worker thread and append its report
+    to reports
+    """
+    try:
+        reports.append(_billing_worker(*args))
+    except Exception:
+        log.exception('billing worker failed')
+        reports.append({
+            'invoices': [],
+            'skipped': [],
+            'errors': [{
+                'parties': [p for p, c in args[2]],
+                'error': str(sys.exc_info()[1]),
+            }],
+            'stats': BillingStats().summary(),
+        })
+
 class Contract(ModelWorkflow, ModelSQL, ModelView):
     """Contract Agreement"""
     _name = 'contract.contract'
@@ -69,6 +234,16 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
     stop_date = fields.Date('Until')
     lines = fields.One2Many('account.invoice.line', 'contract', 'Invoice Lines',
                            readonly=True, domain=[('contract','=',Eval('id'))])
+    invoiced_amount = fields.Function(fields.Numeric('Invoiced',
+        digits=(16, 2), help='Untaxed amount of the open and paid invoice '
+        'lines, net of credit notes'), 'get_invoice_summary')
+    open_amount = fields.Function(fields.Numeric('Open',
+        digits=(16, 2), help='Untaxed amount of the open invoice lines, '
+        'net of credit notes'), 'get_invoice_summary')
+    invoice_count = fields.Function(fields.Integer('Invoices'),
+        'get_invoice_summary')
+    last_invoice_date = fields.Function(fields.Date('Last Invoice'),
+        'get_invoice_summary')
 
 
     def __init__(self):
@@ -76,12 +251,78 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
         self._rpc.update({
             'create_next_invoice': True,
             'create_invoice_batch': True,
+            'create_invoice_batch_chunked': True,
+            'create_invoice_batch_background': True,
             'cancel_with_credit': True,
         })
 
+    def init(self, module_name):
+        super(Contract, self).init(module_name)
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, self, module_name)
+
+        # Index used by _due_domain to select the contracts due for billing
+        table.index_action(['state', 'next_invoice_date'], action='add')
+
     def default_state(self):
         return 'draft'
 
+    def get_invoice_summary(self, ids, names):
+        """
+        Compute the invoice fields with one aggregated query on the invoice
+        lines per IN_MAX contracts. Draft, proforma and canceled invoices
+        are left out, credit notes count negative in the amounts and the
+        invoice count and are not taken as the last invoice date.
+        """
+        cursor = Transaction().cursor
+        invoice_obj = self.pool.get('account.invoice')
+        invoice_line_obj = self.pool.get('account.invoice.line')
+
+        res = {}
+        defaults = {
+            'invoiced_amount': Decimal('0.00'),
+            'open_amount': Decimal('0.00'),
+            'invoice_count': 0,
+            'last_invoice_date': None,
+        }
+        for name in names:
+            res[name] = dict([(x, defaults[name]) for x in ids])
+
+        amount = '(CASE WHEN i.type = %s THEN -1 ELSE 1 END) ' \
+                '* l.quantity * l.unit_price'
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('l.contract', sub_ids)
+            cursor.execute('SELECT l.contract, '
+                    'SUM(' + amount + '), '
+                    'SUM(CASE WHEN i.state = %s THEN ' + amount
+                        + ' ELSE 0 END), '
+                    'COUNT(DISTINCT CASE WHEN i.type != %s THEN i.id END) '
+                    '- COUNT(DISTINCT CASE WHEN i.type = %s THEN i.id END), '
+                    'MAX(CASE WHEN i.type != %s THEN i.invoice_date END) '
+                'FROM "' + invoice_line_obj._table + '" l '
+                'JOIN "' + invoice_obj._table + '" i ON (i.id = l.invoice) '
+                'WHERE ' + red_sql + ' AND i.state IN (%s, %s) '
+                'GROUP BY l.contract',
+                ['out_credit_note', 'open', 'out_credit_note']
+                + ['out_credit_note'] * 3 + red_ids + ['open', 'paid'])
+            for (contract_id, invoiced, open_, count,
+                    last_date) in cursor.fetchall():
+                values = {
+                    'invoiced_amount': Decimal(str(invoiced or 0)).quantize(
+                        Decimal('0.01')),
+                    'open_amount': Decimal(str(open_ or 0)).quantize(
+                        Decimal('0.01')),
+                    'invoice_count': count,
+                    'last_invoice_date': last_date,
+                }
+                if isinstance(last_date, basestring):
+                    values['last_invoice_date'] = datetime.date(
+                        *time.strptime(last_date, '%Y-%m-%d')[:3])
+                for name in names:
+                    res[name][contract_id] = values[name]
+        return res
+
     def default_interval(self):
         return 'month'
 
@@ -99,16 +340,13 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
 
     def default_payment_term(self):
         config_obj = self.pool.get('contract.configuration')
-        config = config_obj.browse(1)
-        if config.payment_term:
-            return config.payment_term.id
+        config = config_obj.get_defaults()
+        if config['payment_term']:
+            return config['payment_term']
 
-        company_id = self.default_company()
         company_obj = self.pool.get('company.company')
-        company = company_obj.browse(company_id)
-        if company and company.payment_term:
-            return company.payment_term.id
-        return False
+        company = company_obj.get_contract_defaults(self.default_company())
+        return company['payment_term']
 
     def default_journal(self):
         journal_obj = self.pool.get('account.journal')
@@ -141,77 +379,167 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
 
         return super(Contract, self).write(ids, vals)
 
+    def _read_snapshots(self, contract_ids):
+        """
+        returns the ContractSnapshot of each contract in contract_ids, in
+        the same order, with their party, product and company snapshots
+
+        Everything the billing path needs is read in bulk: one read for
+        the contracts and one for each of their parties, products and
+        companies, plus one search and read for the invoice addresses.
+        Contracts sharing a party, product or company share its snapshot.
+        """
+        party_obj = self.pool.get('party.party')
+        address_obj = self.pool.get('party.address')
+        product_obj = self.pool.get('product.product')
+        company_obj = self.pool.get('company.company')
+
+        rows = self.read(contract_ids,
+                         [x for x in ContractSnapshot.__slots__ if x != 'id'])
+
+        def load(obj, snapshot_class, ids):
+            field_names = [x for x in snapshot_class.__slots__
+                           if x in obj._columns or x in obj._inherit_fields]
+            res = {}
+            for values in obj.read(list(set(ids)), field_names):
+                res[values['id']] = snapshot_class(values)
+            return res
+
+        parties = load(party_obj, PartySnapshot,
+                       [x['party'] for x in rows])
+        products = load(product_obj, ProductSnapshot,
+                        [x['product'] for x in rows])
+        companies = load(company_obj, CompanySnapshot,
+                         [x['company'] for x in rows])
+
+        # same choice as party.address_get(type='invoice'): the first
+        # invoice address, or else the first address
+        address_ids = address_obj.search([
+            ('party', 'in', list(parties.keys())),
+            ('active', '=', True),
+        ], order=[('sequence', 'ASC'), ('id', 'ASC')])
+        address_fields = ['party']
+        if 'invoice' in address_obj._columns:
+            address_fields.append('invoice')
+        addresses = {}
+        for address in address_obj.read(address_ids, address_fields):
+            addresses[address['id']] = address
+        first = {}
+        invoice = {}
+        for address_id in address_ids:
+            address = addresses[address_id]
+            first.setdefault(address['party'], address_id)
+            if address.get('invoice'):
+                invoice.setdefault(address['party'], address_id)
+        for party_id, party in parties.items():
+            party.invoice_address = invoice.get(party_id) \
+                    or first.get(party_id, False)
+
+        snapshots = {}
+        for values in rows:
+            values['party'] = parties[values['party']]
+            values['product'] = products[values['product']]
+            values['company'] = companies[values['company']]
+            snapshots[values['id']] = ContractSnapshot(values)
+        return [snapshots[x] for x in contract_ids]
+
     def _invoice_init(self, contract, invoice_date):
         invoice_obj = self.pool.get('account.invoice')
-        invoice_address = contract.party.address_get(contract.party.id, type='invoice')
         config_obj = self.pool.get('contract.configuration')
-        config = config_obj.browse(1)
-        description = config.description
+        company_obj = self.pool.get('company.company')
+        description = config_obj.get_defaults()['description']
+        company = company_obj.get_contract_defaults(contract.company.id)
 
         invoice = invoice_obj.create(dict(
             company=contract.company.id,
             type='out_invoice',
             description=description,
             state='draft',
-            currency=contract.company.currency.id,
-            journal=contract.journal.id,
-            account=contract.party.account_receivable.id or contract.company.account_receivable.id,
-            payment_term=contract.party.payment_term.id or contract.payment_term.id,
+            currency=company['currency'],
+            journal=contract.journal,
+            account=contract.party.account_receivable or company['account_receivable'],
+            payment_term=contract.party.payment_term or contract.payment_term,
             party=contract.party.id,
-            invoice_address=invoice_address,
+            invoice_address=contract.party.invoice_address,
             invoice_date=invoice_date,
         ))
         return invoice_obj.browse([invoice])[0]
 
     def _contract_unit_price(self, contract):
-        unit_price = contract.product.list_price
-        if contract.list_price:
-            unit_price = contract.list_price
-        elif contract.discount:
-            unit_price = contract.product.list_price - (contract.product.list_price * contract.discount / 100)
-        return unit_price
+        return contract_unit_price(contract.product.list_price,
+                                   contract.list_price, contract.discount)
 
 
-    def _invoice_append(self, invoice, contract, period):
+    def _invoice_line_values(self, contract, period, cache=None,
+            stats=None):
+        """
+        returns the values for the invoice line billing contract, a
+        ContractSnapshot, over period, or None if the contract has no unit
+        price
+
+        Accounts, taxes and tax rules are resolved through cache, a
+        BillingCache shared by the whole batch run when given. Skipped
+        contracts and the time spent on taxes are recorded in stats, a
+        BillingStats, when given.
+        """
         (last_date, next_date, quant) = period
-        line_obj = self.pool.get('account.invoice.line')
 
         quantity = Decimal("%f" % quant)
         unit_price = self._contract_unit_price(contract)
         if not unit_price:
             # skip this contract
-            log.info("skip contract without unit_price: %s contract.product.list_price: %s contract.list_price: %s contract.discount: %s" %(
-                unit_price, contract.product.list_price, contract.list_price,
-                contract.discount))
-            return
+            log.debug("skip contract %s without unit_price: %s contract.product.list_price: %s contract.list_price: %s contract.discount: %s",
+                contract.id, unit_price, contract.product.list_price,
+                contract.list_price, contract.discount)
+            if stats is not None:
+                stats.skip('no_unit_price')
+            return None
 
         linedata = dict(
             type='line',
             product=contract.product.id,
-            invoice=invoice.id,
             description="%s: %s (%s - %s)" % (contract.name, contract.product.name, last_date, next_date),
             quantity=quantity,
-            unit=contract.product.default_uom.id,
+            unit=contract.product.default_uom,
             unit_price=unit_price,
             contract=contract.id,
             taxes=[],
         )
 
-        account = contract.product.get_account([contract.product.id],'account_revenue_used')
+        if cache is None:
+            cache = BillingCache()
+        if stats is None:
+            stats = BillingStats()
+
+        product_obj = self.pool.get('product.product')
+        account = cache.account(product_obj, contract.product.id,
+                                contract.company.id)
         if account: 
-            linedata['account'] = account.popitem()[1]
+            linedata['account'] = account
 
         tax_rule_obj = self.pool.get('account.tax.rule')
-        taxes = contract.product.get_taxes([contract.product.id], 'customer_taxes_used')
-        for tax in taxes[contract.product.id]:
-            pattern = {}
-            if contract.party.customer_tax_rule:
-                tax_ids = tax_rule_obj.apply(contract.party.customer_tax_rule, tax, pattern)
-                if tax_ids:
-                    for tax_id in tax_ids:
-                        linedata['taxes'].append(('add',tax_id))
-                    continue
-            linedata['taxes'].append(('add',tax))
+        with stats.measure('tax'):
+            taxes = cache.taxes(product_obj, contract.product.id,
+                                contract.company.id)
+            for tax in taxes:
+                if contract.party.customer_tax_rule:
+                    tax_ids = cache.tax_rule(tax_rule_obj,
+                        contract.party.customer_tax_rule, tax)
+                    if tax_ids:
+                        for tax_id in tax_ids:
+                            linedata['taxes'].append(('add',tax_id))
+                        continue
+                linedata['taxes'].append(('add',tax))
+
+        return linedata
+
+    def _invoice_append(self, invoice, contract, period):
+        line_obj = self.pool.get('account.invoice.line')
+
+        linedata = self._invoice_line_values(contract, period)
+        if not linedata:
+            return
+        linedata['invoice'] = invoice.id
 
         if contract.reference and not invoice.reference:
             invoice_obj = self.pool.get('account.invoice')
@@ -219,6 +547,96 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
 
         return line_obj.create(linedata)
 
+    def _invoice_append_batch(self, invoice, info, cache=None, stats=None):
+        """
+        Add the lines for all (contract, period) tuples in info to invoice
+        with a single write on the invoice, which also sets the invoice
+        reference from the first contract that has one.
+
+        returns the list of contract ids that got an invoice line
+        """
+        invoice_obj = self.pool.get('account.invoice')
+
+        lines = []
+        contract_ids = []
+        reference = invoice.reference
+        for (contract, period) in info:
+            linedata = self._invoice_line_values(contract, period,
+                                                 cache=cache, stats=stats)
+            if not linedata:
+                continue
+            lines.append(('create', linedata))
+            contract_ids.append(contract.id)
+            if contract.reference and not reference:
+                reference = contract.reference
+
+        if not lines:
+            return contract_ids
+
+        vals = {'lines': lines}
+        if reference and reference != invoice.reference:
+            vals['reference'] = reference
+        invoice_obj.write(invoice.id, vals)
+        return contract_ids
+
+    def _set_opt_invoice_dates(self, dates):
+        """
+        Store the end of the billed period on contracts.
+
+        dates maps contract id to the new opt_invoice_date; contracts
+        sharing a date are written together.
+        """
+        self._write_billing_dates('opt_invoice_date', dates)
+
+    def _write_billing_dates(self, name, dates):
+        """
+        Store the billing bookkeeping date name (opt_invoice_date or
+        next_invoice_date) on contracts.
+
+        dates maps contract id to the new date. The contracts sharing a
+        date are updated with one UPDATE per IN_MAX contracts, which sets
+        write_uid and write_date as write does but skips the access,
+        workflow and trigger processing of write. When triggers on write
+        exist for contracts, write is used instead so they still fire.
+        """
+        cursor = Transaction().cursor
+        trigger_obj = self.pool.get('ir.trigger')
+        assert name in ('opt_invoice_date', 'next_invoice_date')
+
+        by_date = {}
+        for contract_id, date in dates.items():
+            by_date.setdefault(date, []).append(contract_id)
+
+        if trigger_obj.get_triggers(self._name, 'write'):
+            for date, contract_ids in by_date.items():
+                self.write(contract_ids, {name: date})
+            return
+
+        now = datetime.datetime.now()
+        for date, contract_ids in by_date.items():
+            for i in range(0, len(contract_ids), cursor.IN_MAX):
+                sub_ids = contract_ids[i:i + cursor.IN_MAX]
+                red_sql, red_ids = reduce_ids('id', sub_ids)
+                cursor.execute('UPDATE "' + self._table + '" '
+                    'SET "' + name + '" = %s, write_uid = %s, '
+                        'write_date = %s '
+                    'WHERE ' + red_sql,
+                    [date, Transaction().user, now] + red_ids)
+
+        self._clear_cursor_cache(list(dates))
+
+    def _clear_cursor_cache(self, ids):
+        """
+        Drop the values of the contracts in ids from the cursor cache, as
+        ModelStorage.write does, after they are updated with plain SQL
+        """
+        for cache in Transaction().cursor.cache.values():
+            for cache in (cache, cache.get('_language_cache', {}).values()):
+                if self._name in cache:
+                    for contract_id in ids:
+                        if contract_id in cache[self._name]:
+                            cache[self._name][contract_id] = {}
+
     def cancel_with_credit(self, ids):
         """ 
         
@@ -226,28 +644,81 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
         i.e. in case of failure to provide proper and
         valid credentials such as an initial payment.
 
-        """
-        contract_obj = self.pool.get('contract.contract')
-        contract = self.browse(ids)[0]
-        if not contract.state == 'active':
-            return {}
+        Only active contracts are canceled, the others are skipped. The
+        contracts are canceled with bulk_transition and only the open
+        invoices of the contracts it canceled are credited, each once,
+        however many of these contracts it bills.
 
-        for id in ids:
-            self.workflow_trigger_validate(id, 'cancel')
+        returns a dict mapping each contract id to a dict with the
+        'result' ('canceled', 'skipped' or the bulk_transition outcome of
+        a contract it could not cancel: 'invalid', 'denied' or
+        'missing'), the 'invoices' credited for it and the resulting
+        'credits'
 
+        """
+        cursor = Transaction().cursor
         invoice_obj = self.pool.get('account.invoice')
         invoice_line_obj = self.pool.get('account.invoice.line')
-        line_ids = invoice_line_obj.search([('contract','in',ids)])
-        if not line_ids:
-            return {}
 
-        invoices = []
-        lines = invoice_line_obj.browse(line_ids)
-        for l in lines:
-            invoices.append(l.invoice.id)
-        invoice_obj.credit(invoices, refund=True)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+
+        res = {}
+        active_ids = []
+        for contract in self.read(ids, ['state']):
+            if contract['state'] == 'active':
+                active_ids.append(contract['id'])
+                res[contract['id']] = {
+                    'result': 'canceled',
+                    'invoices': [],
+                    'credits': [],
+                }
+            else:
+                res[contract['id']] = {
+                    'result': 'skipped',
+                    'invoices': [],
+                    'credits': [],
+                }
+        if not active_ids:
+            return res
+
+        outcomes = self.bulk_transition(active_ids, 'cancel')
+        canceled_ids = []
+        for contract_id in active_ids:
+            if outcomes[contract_id] == 'done':
+                canceled_ids.append(contract_id)
+            else:
+                res[contract_id]['result'] = outcomes[contract_id]
+        if len(canceled_ids) < len(active_ids):
+            log.warning('contracts not canceled: %s', [x for x in active_ids
+                if outcomes[x] != 'done'])
+        active_ids = canceled_ids
+        if not active_ids:
+            return res
+
+        invoice2contracts = {}
+        for i in range(0, len(active_ids), cursor.IN_MAX):
+            sub_ids = active_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('l.contract', sub_ids)
+            cursor.execute('SELECT DISTINCT l.invoice, l.contract '
+                'FROM "' + invoice_line_obj._table + '" l '
+                'JOIN "' + invoice_obj._table + '" i ON (i.id = l.invoice) '
+                'WHERE ' + red_sql + ' AND i.state = %s AND i.type = %s',
+                red_ids + ['open', 'out_invoice'])
+            for invoice_id, contract_id in cursor.fetchall():
+                invoice2contracts.setdefault(invoice_id, []).append(
+                    contract_id)
+        if not invoice2contracts:
+            return res
+
+        invoice_ids = sorted(invoice2contracts.keys())
+        credit_ids = invoice_obj.credit(invoice_ids, refund=True)
+        for invoice_id, credit_id in zip(invoice_ids, credit_ids):
+            for contract_id in invoice2contracts[invoice_id]:
+                res[contract_id]['invoices'].append(invoice_id)
+                res[contract_id]['credits'].append(credit_id)
 
-        return {}
+        return res
 
     def create_next_invoice(self, ids, data=None):
         if data.get('form') and data['form'].get('invoice_date'):
@@ -256,19 +727,20 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
             invoice_date = datetime.date.today()
 
         contract_obj = self.pool.get('contract.contract')
-        contract = self.browse(ids)[0]
+        contract = self._read_snapshots(ids[:1])[0]
 
         period = self._check_contract(contract, invoice_date)
         if not period: return {}
 
-        log.debug("invoice_date: %s period: %s" %(invoice_date, period))
+        log.debug("invoice_date: %s period: %s", invoice_date, period)
 
         ## create a new invoice
         invoice = self._invoice_init(contract, invoice_date)
 
         ## create invoice lines
         line = self._invoice_append(invoice, contract, period)
-        self.write(contract.id, {'opt_invoice_date': period[1]})
+        self._write_billing_dates('opt_invoice_date',
+                                  {contract.id: period[1]})
 
 
         return invoice.id
@@ -291,89 +763,140 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
         if not contract.state == 'active':
             return {}
 
-        # don't invoice contracts unless they are due within 30 days
-        # after the invoice_date
-        end = invoice_date + datetime.timedelta(NOTICE_DAYS)
-        
-        if contract.next_invoice_date and end < contract.next_invoice_date:
-            log.info('too early to invoice: %s + %d days < %s' %(invoice_date,
-                                                                 NOTICE_DAYS,
-                                                                 end))
-            return False
-
-        last_date = contract.next_invoice_date or contract.start_date or invoice_date
-        next_date = last_date
-        quant = 0
-
-        while next_date < end:
-            if contract.interval == 'year':
-                next_date = next_date + relativedelta(years=contract.interval_quant)
-                quant = relativedelta(next_date, last_date).years
+        return self._check_contracts([contract], invoice_date)[contract.id]
 
-            elif contract.interval == 'month':
-                next_date = next_date + relativedelta(months=contract.interval_quant)
-                delta = relativedelta(next_date, last_date)
-                quant = delta.years * 12 + delta.months
+    def _check_contracts(self, contracts, invoice_date, stats=None):
+        """
+        returns a dict mapping contract id to 'period' or False
 
-            elif contract.interval == 'week':
-                next_date = next_date + relativedelta(weeks=contract.interval_quant)
-                quant = (next_date - last_date).days/7
+        Evaluates all contracts in one pass, using the same rules as
+        _check_contract. Contracts that are not active are mapped to False.
+        The contracts mapped to False are counted per reason in stats, a
+        BillingStats, when given.
 
-            elif contract.interval == 'day':
-                next_date = next_date + relativedelta(days=contract.interval_quant)
-                quant = (next_date - last_date).days
+        """
+        if stats is None:
+            stats = BillingStats()
+        # don't invoice contracts unless they are due within NOTICE_DAYS
+        # after the invoice_date
+        end = invoice_date + datetime.timedelta(NOTICE_DAYS)
 
-        if next_date and contract.stop_date and next_date > contract.stop_date:
-            log.info('contract stopped: %s > %s' % (next_date, contract.stop_date))
-            return False
+        res = {}
+        for contract in contracts:
+            res[contract.id] = False
+            if not contract.state == 'active':
+                stats.skip('inactive')
+                continue
+
+            if contract.next_invoice_date and end < contract.next_invoice_date:
+                log.debug('too early to invoice %s: %s + %d days < %s',
+                          contract.id, invoice_date, NOTICE_DAYS,
+                          contract.next_invoice_date)
+                stats.skip('too_early')
+                continue
+
+            last_date = contract.next_invoice_date or contract.start_date \
+                    or invoice_date
+            next_date, quant = billing_period(contract.interval,
+                                              contract.interval_quant,
+                                              last_date, end)
+
+            if next_date and contract.stop_date and next_date > contract.stop_date:
+                log.debug('contract %s stopped: %s > %s', contract.id,
+                          next_date, contract.stop_date)
+                stats.skip('stopped')
+                continue
+
+            quant = quant * contract.quantity
+
+            log.debug("last_date: %s next_date: %s quant: %d", last_date,
+                      next_date, quant)
+            res[contract.id] = (last_date, next_date, quant)
+        return res
 
-        quant = quant * contract.quantity
+    def _due_domain(self, invoice_date):
+        """
+        returns the search domain for the contracts that may be due for
+        billing at invoice_date
 
-        log.debug("last_date: %s next_date: %s quant: %d" % (last_date,next_date,quant))
-        return (last_date, next_date, quant)
+        It selects a superset of the contracts _check_contracts accepts:
+        active contracts that started, whose next_invoice_date is unset or
+        within NOTICE_DAYS, and that are not stopped before the period
+        that would be billed.
 
-    def create_invoice_batch(self, party=None, data=None):
-        if data and data.get('form') and data['form'].get('invoice_date'):
-            invoice_date = data['form']['invoice_date']
-        else:
-            invoice_date = datetime.date.today()
+        Billing runs take the due contracts from the billing queue
+        instead; this domain is the reference selection the queue is
+        checked against by BillingQueue.verify.
+        """
+        end = invoice_date + datetime.timedelta(NOTICE_DAYS)
+        return [
+            ('state', '=', 'active'),
+            ('start_date', '<=', invoice_date),
+            ['OR',
+                ('next_invoice_date', '=', False),
+                ('next_invoice_date', '<=', end),
+            ],
+            ['OR',
+                ('stop_date', '=', False),
+                ('stop_date', '>=', end),
+            ],
+        ]
+
+    def _search_due_contracts(self, invoice_date, party=None, domain=None):
+        """
+        returns the ids of the contracts that may be due for billing at
+        invoice_date, optionally limited to party (an id or a list of ids)
+        and to the extra domain clauses in domain
+        """
+        query = self._due_domain(invoice_date)
 
-        log.info("create invoice batch with invoice_date: %s" % invoice_date)
+        """
+        filter on party if required
+        """
+        if party:
+            if type(party) != type([1,]):
+                party = [party,]
+            query.append(('party','in',party))
 
-        contract_obj = self.pool.get('contract.contract')
+        if domain:
+            query.extend(domain)
 
-        contract_ids = None
-        if data and data.get('model') == 'contract.contract':
-            contract_ids = data.get('ids')
-        if not contract_ids:
-            """ 
-            get a list of all active contracts
-            """
-            query = [('state','=','active'), 
-                     ('start_date','<=',invoice_date),
-                    ]
+        return self.search(query)
 
-            """
-            filter on party if required
-            """
-            if party:
-                if type(party) != type([1,]):
-                    party = [party,]
-                query.append(('party','in',party))
+    def _bill_contracts(self, contract_ids, invoice_date, cache=None,
+            skipped=None, stats=None):
+        """
+        Create one draft invoice per party for the contracts in
+        contract_ids that are due at invoice_date. The contracts are read
+        as snapshots with _read_snapshots.
 
-            contract_ids = contract_obj.search(query)
+        The ids of the contracts that did not get an invoice line are
+        appended to skipped when it is a list. The time spent per phase and
+        the skipped contracts are recorded in stats, a BillingStats, when
+        given.
 
-            if not contract_ids:
-                return []
+        returns the list of created invoice ids
+        """
+        if cache is None:
+            cache = BillingCache()
+        if stats is None:
+            stats = BillingStats()
 
         """
         build the list of all billable contracts
         and aggragate the result per party
         """
         batch = {}
-        contracts = contract_obj.browse(contract_ids)
+        with stats.measure('load'):
+            contracts = self._read_snapshots(contract_ids)
+        with stats.measure('check'):
+            periods = self._check_contracts(contracts, invoice_date,
+                                            stats=stats)
+        stats.count('contracts', len(contract_ids))
         for contract in contracts:
-            period = self._check_contract(contract, invoice_date)
+            period = periods[contract.id]
+            if period and not period[2]:
+                stats.skip('no_quantity')
             if period and period[2]:
                 key = contract.party.id
                 if not batch.get(key): batch[key] = []
@@ -384,21 +907,331 @@ class Contract(ModelWorkflow, ModelSQL, ModelView):
         for all billable contracts
         """
         res = []
+        dates = {}
+        billed = set()
         for party, info in batch.items():
-            invoice = self._invoice_init(info[0][0], invoice_date)
+            with stats.measure('init'):
+                invoice = self._invoice_init(info[0][0], invoice_date)
+            with stats.measure('append'):
+                billed.update(self._invoice_append_batch(invoice, info,
+                    cache=cache, stats=stats))
             for (contract, period) in info:
-                self._invoice_append(invoice, contract, period)
-                self.write(contract.id, {'opt_invoice_date': period[1]})
+                dates[contract.id] = period[1]
             res.append(invoice.id)
+        with stats.measure('write'):
+            self._set_opt_invoice_dates(dates)
+        stats.count('invoices', len(res))
+        stats.count('lines', len(billed))
+
+        if skipped is not None:
+            skipped.extend([x for x in contract_ids if x not in billed])
+        return res
+
+    def create_invoice_batch(self, party=None, data=None, background=False):
+        """
+        Bill all contracts due at the invoice_date of the wizard form in
+        data, or today, with one draft invoice per party.
+
+        The time and calls per phase and the skipped contracts are logged,
+        see _create_invoice_batch. Setting 'billing_profile' in the
+        context dumps a cProfile of the run, see run_profiled.
+
+        With background set, the run is queued as a contract.billing.run
+        processed by a worker instead, see create_invoice_batch_background.
+
+        returns the list of created invoice ids, or the id of the queued
+        billing run
+        """
+        if background:
+            return self.create_invoice_batch_background(party=party,
+                                                        data=data)
+        return run_profiled(self._create_invoice_batch, party=party,
+                            data=data)
+
+    def create_invoice_batch_background(self, party=None, data=None):
+        """
+        Queue the billing of the contracts selected as for
+        create_invoice_batch as a contract.billing.run and return at once.
+
+        The run is processed by a worker thread, or else by the cron, in
+        chunks like create_invoice_batch_chunked. Its progress and the
+        created invoices can be polled with its get_status method.
+
+        returns the id of the billing run
+        """
+        run_obj = self.pool.get('contract.billing.run')
+
+        if data and data.get('form') and data['form'].get('invoice_date'):
+            invoice_date = data['form']['invoice_date']
+        else:
+            invoice_date = datetime.date.today()
+
+        contract_ids = None
+        if data and data.get('model') == 'contract.contract':
+            contract_ids = data.get('ids')
+        if not contract_ids and party:
+            contract_ids = self._search_due_contracts(invoice_date,
+                                                      party=party)
+            if not contract_ids:
+                return False
+        return run_obj.enqueue(invoice_date, contract_ids=contract_ids)
+
+    def _create_invoice_batch(self, party=None, data=None, stats=None):
+        """
+        Bill the contracts as described in create_invoice_batch.
+
+        The time and calls per phase and the skipped contracts are
+        recorded in stats, a BillingStats, when given by an internal
+        caller, and logged.
+
+        returns the list of created invoice ids
+        """
+        if stats is None:
+            stats = BillingStats()
+        if data and data.get('form') and data['form'].get('invoice_date'):
+            invoice_date = data['form']['invoice_date']
+        else:
+            invoice_date = datetime.date.today()
+
+        log.info("create invoice batch with invoice_date: %s", invoice_date)
+
+        contract_ids = None
+        if data and data.get('model') == 'contract.contract':
+            contract_ids = data.get('ids')
+        if not contract_ids:
+            """ 
+            get a list of all contracts due for billing
+            """
+            with stats.measure('search'):
+                contract_ids = self._search_due_contracts(invoice_date,
+                                                          party=party)
+
+            if not contract_ids:
+                return []
+
+        cache = BillingCache()
+        res = self._bill_contracts(contract_ids, invoice_date, cache=cache,
+                                   stats=stats)
+        log.info("billing cache (hits, misses): %s", cache.stats())
+        log.info("billing statistics: %s", stats.summary())
+        return res
+
+    def _due_contracts_by_party(self, invoice_date, party=None,
+            after_party=None):
+        """
+        returns a list of (party id, contract ids) tuples sorted on party
+        id for the contracts that may be due at invoice_date, leaving out
+        the parties up to and including after_party
+        """
+        domain = None
+        if after_party:
+            domain = [('party', '>', after_party)]
+        contract_ids = self._search_due_contracts(invoice_date, party=party,
+                                                  domain=domain)
+        return self._contracts_by_party(contract_ids)
+
+    def _contracts_by_party(self, contract_ids, after_party=None):
+        """
+        returns a list of (party id, contract ids) tuples sorted on party
+        id for the contracts in contract_ids, leaving out the parties up to
+        and including after_party
+        """
+        cursor = Transaction().cursor
+
+        by_party = {}
+        for i in range(0, len(contract_ids), cursor.IN_MAX):
+            sub_ids = contract_ids[i:i + cursor.IN_MAX]
+            for values in self.read(sub_ids, ['party']):
+                if after_party and values['party'] <= after_party:
+                    continue
+                by_party.setdefault(values['party'], []).append(values['id'])
+        return sorted(by_party.items())
+
+    def create_invoice_batch_chunked(self, invoice_date=None, party=None,
+            chunk_size=None, run_id=None):
+        """
+        Streaming variant of create_invoice_batch.
+
+        Due contracts are billed party by party in chunks of chunk_size
+        parties. After each chunk the transaction is committed together
+        with a checkpoint on the contract.billing.run record, so a failure
+        only rolls back the current chunk.
+
+        A queued or interrupted run is processed by passing its run_id,
+        once BillingRun.claim claimed it: the parties up to the checkpoint
+        are skipped, as their contracts are already invoiced (their
+        opt_invoice_date is set, but next_invoice_date only moves once the
+        invoices are opened). A run that is done or still being processed
+        is left alone.
+
+        The BillingStats summary of the run and the created invoices are
+        stored with each checkpoint and a cProfile is dumped as for
+        create_invoice_batch. A run with contracts only bills these.
+
+        returns the id of the billing run
+        """
+        return run_profiled(self._create_invoice_batch_chunked,
+                            invoice_date=invoice_date, party=party,
+                            chunk_size=chunk_size, run_id=run_id)
+
+    def _create_invoice_batch_chunked(self, invoice_date=None, party=None,
+            chunk_size=None, run_id=None):
+        run_obj = self.pool.get('contract.billing.run')
+        cursor = Transaction().cursor
+
+        if run_id:
+            claimed = run_obj.claim(run_id)
+            cursor.commit()
+            if not claimed:
+                log.info("billing run %s is done or being processed",
+                         run_id)
+                return run_id
+            run = run_obj.browse(run_id)
+            invoice_date = run.invoice_date
+            chunk_size = chunk_size or run.chunk_size
+            after_party = run.last_party.id
+        else:
+            invoice_date = invoice_date or datetime.date.today()
+            chunk_size = chunk_size or run_obj.default_chunk_size()
+            after_party = False
+            run_id = run_obj.create({
+                'invoice_date': invoice_date,
+                'chunk_size': chunk_size,
+                'state': 'running',
+            })
+        cursor.commit()
+
+        log.info("create invoice batch run %s with invoice_date: %s",
+                 run_id, invoice_date)
+
+        stats = BillingStats()
+        run = run_obj.browse(run_id)
+        if run.stats:
+            stats.update(json.loads(run.stats))
+        try:
+            with stats.measure('search'):
+                if run.contracts:
+                    parties = self._contracts_by_party(
+                        [x.id for x in run.contracts],
+                        after_party=after_party)
+                else:
+                    parties = self._due_contracts_by_party(invoice_date,
+                        party=party, after_party=after_party)
+            run_obj.write(run_id, {
+                'party_total': run.party_count + len(parties),
+            })
+            cache = BillingCache()
+            for i in range(0, len(parties), chunk_size):
+                chunk = parties[i:i + chunk_size]
+                contract_ids = []
+                for party_id, party_contract_ids in chunk:
+                    contract_ids.extend(party_contract_ids)
+                invoice_ids = self._bill_contracts(contract_ids, invoice_date,
+                                                   cache=cache, stats=stats)
+                run = run_obj.browse(run_id)
+                run_obj.write(run_id, {
+                    'last_party': chunk[-1][0],
+                    'party_count': run.party_count + len(chunk),
+                    'invoice_count': run.invoice_count + len(invoice_ids),
+                    'invoices': [('add', invoice_ids)],
+                    'stats': stats.dumps(),
+                })
+                cursor.commit()
+            run_obj.write(run_id, {'state': 'done'})
+            cursor.commit()
+        except Exception:
+            cursor.rollback()
+            run_obj.write(run_id, {
+                'state': 'failed',
+                'error': str(sys.exc_info()[1]),
+            })
+            cursor.commit()
+            raise
+
+        log.info("billing cache (hits, misses): %s", cache.stats())
+        log.info("billing statistics: %s", stats.summary())
+        return run_id
+
+    def create_invoice_batch_parallel(self, invoice_date=None, party=None,
+            workers=None, chunk_size=None):
+        """
+        Parallel variant of create_invoice_batch, for a cron or a script
+        only; it is not exposed over RPC.
+
+        The parties with due contracts are partitioned over workers
+        threads, balanced on their number of contracts. Each worker bills
+        its parties in a transaction of its own, on its own database
+        connection, committing every chunk_size parties, so their database
+        work overlaps. As the workers only see committed data, the current
+        transaction is committed before they start: the caller can not
+        roll the run back. On SQLite, or with a single worker, the
+        partitions are billed in the current transaction instead.
+
+        returns a dict with the created invoice ids, the ids of the
+        contracts that were not billed, the errors of failed chunks and the
+        BillingStats summary of all workers as 'stats'
+        """
+        cursor = Transaction().cursor
+        invoice_date = invoice_date or datetime.date.today()
+        chunk_size = chunk_size or CHUNK_SIZE
+
+        parties = self._due_contracts_by_party(invoice_date, party=party)
+
+        threaded = CONFIG['db_type'] != 'sqlite'
+        if threaded and not workers:
+            workers = multiprocessing and multiprocessing.cpu_count() or 1
+        workers = max(1, min(workers or 1, len(parties)))
+        threaded = threaded and workers > 1
+
+        partitions = [[] for i in range(workers)]
+        sizes = [0] * workers
+        for party_id, contract_ids in sorted(parties,
+                key=lambda x: len(x[1]), reverse=True):
+            i = sizes.index(min(sizes))
+            partitions[i].append((party_id, contract_ids))
+            sizes[i] += len(contract_ids)
+
+        log.info("create invoice batch with invoice_date: %s over %d "
+                 "workers", invoice_date, workers)
+
+        args = [(cursor.database_name, invoice_date, partition, chunk_size,
+                 threaded, Transaction().user, Transaction().context.copy())
+                for partition in partitions]
+        if threaded:
+            # the workers only see committed data
+            cursor.commit()
+            reports = []
+            threads = []
+            for x in args:
+                thread = threading.Thread(target=_billing_thread,
+                                          args=(x, reports))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        else:
+            reports = [_billing_worker(*x) for x in args]
+
+        res = {
+            'invoices': [],
+            'skipped': [],
+            'errors': [],
+        }
+        stats = BillingStats()
+        for report in reports:
+            for key in res:
+                res[key].extend(report[key])
+            stats.update(report['stats'])
+        res['stats'] = stats.summary()
+        log.info("billing statistics: %s", res['stats'])
         return res
- 
 
 Contract()
 
 class InvoiceLine(ModelSQL, ModelView):
     """Invoice Line"""
     _name = 'account.invoice.line'
-    contract = fields.Many2One('contract.contract', 'Contract')
+    contract = fields.Many2One('contract.contract', 'Contract', select=1)
 
 InvoiceLine()
 
@@ -407,13 +1240,44 @@ class CreateInvoiceInit(ModelView):
     _name = 'contract.contract.create_invoice.init'
     _description = __doc__
     invoice_date = fields.Date('Invoice Date', help='Use date for generated invoices.')
+    background = fields.Boolean('In Background',
+                                help='Queue a billing run and return at once')
 
     def default_invoice_date(self):
         return datetime.date.today()
 
+    def default_background(self):
+        return False
+
 CreateInvoiceInit()
 
-class CreateNextInvoice(Wizard):
+
+class BackgroundBillingMixin(object):
+    """
+    Wizard states queuing the billing as a contract.billing.run when the
+    background option of the form is set, and opening that run.
+    """
+
+    def _choice(self, data):
+        if data['form'].get('background'):
+            return 'background'
+        return 'invoice'
+
+    def _action_background(self, data):
+        model_data_obj = self.pool.get('ir.model.data')
+        act_window_obj = self.pool.get('ir.action.act_window')
+        contract_obj = self.pool.get('contract.contract')
+
+        run_id = contract_obj.create_invoice_batch_background(data=data)
+
+        act_window_id = model_data_obj.get_id('contract',
+                'act_billing_run_form')
+        res = act_window_obj.read(act_window_id)
+        res['res_id'] = run_id and [run_id] or []
+        res['views'].reverse()
+        return res
+
+class CreateNextInvoice(BackgroundBillingMixin, Wizard):
     'Create Next Invoice'
     _name='contract.contract.create_next_invoice'
     states = {
@@ -430,12 +1294,25 @@ class CreateNextInvoice(Wizard):
         },
 
         'create': {
+            'result': {
+                'type': 'choice',
+                'next_state': '_choice',
+            },
+        },
+        'invoice': {
             'actions': ['_next_invoice'],
             'result': {
                 'type': 'state',
                 'state': 'end',
             },
         },
+        'background': {
+            'result': {
+                'type': 'action',
+                'action': '_action_background',
+                'state': 'end',
+            },
+        },
     }
 
     def _next_invoice(self, data):
@@ -446,7 +1323,7 @@ class CreateNextInvoice(Wizard):
 CreateNextInvoice()
 
 
-class CreateInvoiceBatch(Wizard):
+class CreateInvoiceBatch(BackgroundBillingMixin, Wizard):
     'Create Invoice Batch'
     _name='contract.contract.create_invoice_batch'
     states = {
@@ -463,12 +1340,25 @@ class CreateInvoiceBatch(Wizard):
         },
 
         'create': {
+            'result': {
+                'type': 'choice',
+                'next_state': '_choice',
+            },
+        },
+        'invoice': {
             'actions': ['_invoice_batch'],
             'result': {
                 'type': 'state',
                 'state': 'end',
             },
         },
+        'background': {
+            'result': {
+                'type': 'action',
+                'action': '_action_background',
+                'state': 'end',
+            },
+        },
     }
 
     def _init(self, data):
@@ -0,0 +1,332 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from decimal import Decimal, InvalidOperation
+from trytond.model import ModelView, ModelSQL
+from trytond.transaction import Transaction
+
+import csv
+import datetime
+import time
+import sys
+import logging
+
+log = logging.getLogger(__name__)
+
+# contract fields an import row may set
+IMPORT_FIELDS = [
+    'name',
+    'description',
+    'reference',
+    'company',
+    'journal',
+    'party',
+    'product',
+    'list_price',
+    'discount',
+    'quantity',
+    'payment_term',
+    'interval',
+    'interval_quant',
+    'next_invoice_date',
+    'start_date',
+    'stop_date',
+]
+
+# fields set by on_change_party from the party
+PARTY_FIELDS = [
+    'payment_term',
+    'discount',
+]
+
+# number of rows validated and created together
+IMPORT_CHUNK_SIZE = 1000
+
+
+class RowError(Exception):
+    """
+    A row that can not be imported, with the message reported for it
+    """
+
+
+class ImportCache(object):
+    """
+    Values resolved once per import: the contract defaults, the ids of
+    the Many2One names and the values derived from each party
+    """
+
+    def __init__(self):
+        self.defaults = None
+        self.names = {}
+        self.ids = {}
+        self.parties = {}
+
+
+class Contract(ModelSQL, ModelView):
+    _name = 'contract.contract'
+
+    def __init__(self):
+        super(Contract, self).__init__()
+        self._rpc.update({
+            'import_contracts': True,
+            'import_contracts_csv': True,
+        })
+
+    def _import_defaults(self):
+        """
+        returns the default values of the contract fields for an import,
+        computed once with the defaults of the contract form
+        """
+        return self.default_get(self._defaults.keys(), with_rec_name=False)
+
+    def _import_convert(self, name, value):
+        """
+        returns value of an import row converted to the type of the field
+        name, None for an empty value and the unchanged value for the
+        Many2One fields, they are resolved by _import_resolve
+        """
+        field = self._columns[name]
+        if value is None or value == '':
+            return None
+        if field._type == 'many2one':
+            return value
+        if field._type == 'numeric':
+            try:
+                return Decimal(str(value).strip())
+            except InvalidOperation:
+                raise RowError('%s: %r is not a number' % (name, value))
+        if field._type == 'integer':
+            try:
+                return int(value)
+            except (ValueError, TypeError):
+                raise RowError('%s: %r is not an integer' % (name, value))
+        if field._type == 'date':
+            if isinstance(value, datetime.date):
+                return value
+            try:
+                return datetime.date(*time.strptime(value.strip(),
+                    '%Y-%m-%d')[:3])
+            except (ValueError, TypeError, AttributeError):
+                raise RowError('%s: %r is not a date (YYYY-MM-DD)'
+                               % (name, value))
+        if field._type == 'selection':
+            if not isinstance(value, basestring) \
+                    or value not in dict(field.selection):
+                raise RowError('%s: %r is not one of %s' % (name, value,
+                    ', '.join([x[0] for x in field.selection])))
+        return value
+
+    def _import_resolve(self, rows, cache):
+        """
+        Replace the Many2One values of rows by ids. An integer is taken as
+        an id, a string as the name or code of the record. The names and
+        ids not in cache are looked up with one search per field, the
+        unknown and ambiguous ones are stored as None.
+        """
+        cursor = Transaction().cursor
+        for name in IMPORT_FIELDS:
+            field = self._columns[name]
+            if field._type != 'many2one':
+                continue
+            obj = self.pool.get(field.model_name)
+            names = cache.names.setdefault(name, {})
+            ids = cache.ids.setdefault(name, {})
+
+            new_names = set()
+            new_ids = set()
+            for row, values in rows:
+                value = values.get(name)
+                if isinstance(value, (int, long)):
+                    if value not in ids:
+                        new_ids.add(value)
+                elif value is not None and value not in names:
+                    new_names.add(value)
+
+            new_ids = list(new_ids)
+            for i in range(0, len(new_ids), cursor.IN_MAX):
+                sub_ids = new_ids[i:i + cursor.IN_MAX]
+                found = set(obj.search([('id', 'in', sub_ids)], order=[]))
+                for record_id in sub_ids:
+                    ids[record_id] = record_id in found and record_id or None
+
+            new_names = list(new_names)
+            fields_names = ['rec_name'] + [x for x in ('code', 'name')
+                if x in obj._columns or x in obj._inherit_fields]
+            for i in range(0, len(new_names), cursor.IN_MAX):
+                sub_names = new_names[i:i + cursor.IN_MAX]
+                matches = dict([(x, set()) for x in sub_names])
+                for record in obj.read(obj.search([
+                            ('rec_name', 'in', sub_names),
+                        ], order=[]), fields_names):
+                    for key in fields_names:
+                        if record[key] in matches:
+                            matches[record[key]].add(record['id'])
+                for value, record_ids in matches.items():
+                    if len(record_ids) == 1:
+                        names[value] = record_ids.pop()
+                    else:
+                        names[value] = None
+
+            for row, values in rows:
+                value = values.get(name)
+                if value is None:
+                    continue
+                if isinstance(value, (int, long)):
+                    values[name] = ids[value]
+                else:
+                    values[name] = names[value]
+
+    def _import_party_values(self, party_ids, cache):
+        """
+        Store in cache the values on_change_party sets for each party of
+        party_ids not in it yet, read with one read
+        """
+        party_obj = self.pool.get('party.party')
+        new_ids = [x for x in set(party_ids) if x not in cache.parties]
+        for party in party_obj.read(new_ids, PARTY_FIELDS):
+            values = {
+                'discount': party['discount'] or Decimal('0.0'),
+            }
+            if party['payment_term']:
+                values['payment_term'] = party['payment_term']
+            cache.parties[party['id']] = values
+
+    def _import_chunk(self, rows, cache, errors):
+        """
+        Validate and create the contracts of rows, a list of (row number,
+        values) tuples, with the defaults and party values of cache. The
+        rows that fail, in validation or on create, are appended to errors
+        and the others are still created.
+
+        returns the list of created contract ids
+        """
+        required = [x for x in IMPORT_FIELDS if self._columns[x].required]
+
+        valid = []
+        for row, values in rows:
+            try:
+                # csv.DictReader puts the values past the header under None
+                if None in values:
+                    extra = values[None]
+                    if not isinstance(extra, (list, tuple)):
+                        extra = [extra]
+                    raise RowError('extra columns: %s'
+                        % ', '.join([repr(x) for x in extra]))
+                unknown = [x for x in values if x not in IMPORT_FIELDS]
+                if unknown:
+                    raise RowError('unknown fields: %s'
+                        % ', '.join(sorted([str(x) for x in unknown])))
+                converted = {}
+                for name, value in values.items():
+                    try:
+                        value = self._import_convert(name, value)
+                    except (ValueError, TypeError, AttributeError):
+                        raise RowError('%s: %r can not be imported'
+                                       % (name, value))
+                    if value is not None:
+                        converted[name] = value
+                valid.append((row, converted))
+            except RowError:
+                errors.append((row, str(sys.exc_info()[1])))
+        rows = valid
+
+        self._import_resolve(rows, cache)
+        self._import_party_values([x[1]['party'] for x in rows
+            if x[1].get('party')], cache)
+
+        valid = []
+        for row, values in rows:
+            original = values.copy()
+            values = cache.defaults.copy()
+            if original.get('party'):
+                values.update(cache.parties[original['party']])
+            values.update(original)
+            missing = [x for x in required if not values.get(x)]
+            if missing:
+                errors.append((row, 'missing or unknown %s'
+                               % ', '.join(missing)))
+                continue
+            valid.append((row, values))
+
+        # as run_in_chunks, create the chunk in a savepoint and replay it
+        # row by row when it fails, to report only the failing rows
+        cursor = Transaction().cursor
+        cursor.execute('SAVEPOINT contract_import_chunk')
+        try:
+            contract_ids = [self.create(x[1]) for x in valid]
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT contract_import_chunk')
+            contract_ids = []
+            for row, values in valid:
+                cursor.execute('SAVEPOINT contract_import_row')
+                try:
+                    contract_ids.append(self.create(values))
+                except Exception:
+                    cursor.execute(
+                        'ROLLBACK TO SAVEPOINT contract_import_row')
+                    errors.append((row, str(sys.exc_info()[1])))
+                    continue
+                cursor.execute('RELEASE SAVEPOINT contract_import_row')
+        cursor.execute('RELEASE SAVEPOINT contract_import_chunk')
+        return contract_ids
+
+    def import_contracts(self, rows, chunk_size=None, commit=False):
+        """
+        Create draft contracts from rows, an iterable of dicts mapping
+        IMPORT_FIELDS to values, consumed chunk_size rows at a time.
+
+        The values may be strings, as read from a CSV file: numbers and
+        YYYY-MM-DD dates are converted, Many2One fields take the name or
+        code of the record as well as its id. Missing fields get the
+        defaults of the contract form and the payment term and discount of
+        the party, as on_change_party does; these are resolved once per
+        import, party or name. With commit, the transaction is committed
+        after each chunk.
+
+        returns a dict with the ids of the 'created' contracts, the number
+        of 'rows' and the 'errors' as (row number, message) tuples, rows
+        being numbered from 1
+        """
+        cursor = Transaction().cursor
+        chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+
+        cache = ImportCache()
+        cache.defaults = self._import_defaults()
+        res = {
+            'created': [],
+            'errors': [],
+            'rows': 0,
+        }
+        chunk = []
+        for values in rows:
+            res['rows'] += 1
+            chunk.append((res['rows'], dict(values)))
+            if len(chunk) < chunk_size:
+                continue
+            res['created'].extend(self._import_chunk(chunk, cache,
+                                                     res['errors']))
+            if commit:
+                cursor.commit()
+            chunk = []
+        if chunk:
+            res['created'].extend(self._import_chunk(chunk, cache,
+                                                     res['errors']))
+            if commit:
+                cursor.commit()
+
+        log.info('imported %d contracts from %d rows, %d errors',
+                 len(res['created']), res['rows'], len(res['errors']))
+        return res
+
+    def import_contracts_csv(self, data, delimiter=',', chunk_size=None,
+            commit=False):
+        """
+        Import contracts from CSV data, a string or a file object, whose
+        header line holds the field names, with import_contracts
+        """
+        if isinstance(data, basestring):
+            data = data.splitlines()
+        reader = csv.DictReader(data, delimiter=delimiter)
+        return self.import_contracts(reader, chunk_size=chunk_size,
+                                     commit=commit)
+
+Contract()
@@ -0,0 +1,221 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from __future__ import with_statement
+from decimal import Decimal
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.wizard import Wizard
+from contract import NOTICE_DAYS, billing_period, contract_unit_price
+
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+FORECAST_FIELDS = [
+    'party',
+    'product',
+    'list_price',
+    'discount',
+    'quantity',
+    'interval',
+    'interval_quant',
+    'next_invoice_date',
+    'start_date',
+    'stop_date',
+]
+
+
+class Contract(ModelSQL, ModelView):
+    _name = 'contract.contract'
+
+    def __init__(self):
+        super(Contract, self).__init__()
+        self._rpc.update({
+            'forecast': False,
+        })
+
+    def _forecast_columns(self, party=None):
+        """
+        returns a dict of columns (lists) holding FORECAST_FIELDS, the id
+        and the product list_price of the active contracts, read in bulk.
+        Metered contracts are left out, their usage is not known ahead.
+        """
+        product_obj = self.pool.get('product.product')
+
+        domain = [('state', '=', 'active'), ('metered', '=', False)]
+        if party:
+            if not isinstance(party, list):
+                party = [party]
+            domain.append(('party', 'in', party))
+        rows = self.read(self.search(domain), FORECAST_FIELDS)
+
+        columns = {}
+        for name in ['id'] + FORECAST_FIELDS:
+            columns[name] = [x[name] for x in rows]
+
+        product_prices = {}
+        for product in product_obj.read(list(set(columns['product'])),
+                ['list_price']):
+            product_prices[product['id']] = product['list_price']
+        columns['product_list_price'] = [product_prices[x]
+            for x in columns['product']]
+        return columns
+
+    def forecast(self, from_date, to_date, party=None):
+        """
+        Dry-run the daily invoice batches from from_date to to_date,
+        without creating anything.
+
+        Every active contract that is not metered is billed with the rules
+        of _check_contract and the prices of _contract_unit_price, assuming
+        the invoices are opened, so next_invoice_date moves to the end of
+        each billed period. The contracts are handled as columns read in
+        bulk, all contracts advancing one billing per round.
+
+        returns a dict with the 'total' amount, the number of 'lines' and
+        'invoices' (one per party and day) and the amounts per day, party
+        and product as sorted lists of tuples in 'by_date', 'by_party' and
+        'by_product'
+        """
+        one_day = datetime.timedelta(1)
+        notice = datetime.timedelta(NOTICE_DAYS)
+
+        columns = self._forecast_columns(party=party)
+        count = len(columns['id'])
+        prices = list(map(contract_unit_price, columns['product_list_price'],
+            columns['list_price'], columns['discount']))
+
+        # the day each contract is billed next and the start of its period
+        days = [None] * count
+        lasts = [None] * count
+        for i in range(count):
+            start_date = columns['start_date'][i]
+            last = columns['next_invoice_date'][i] or start_date
+            day = from_date
+            if last:
+                day = max(day, last - notice + one_day)
+            if start_date:
+                day = max(day, start_date)
+            days[i] = day
+            lasts[i] = last or day
+
+        by_date = {}
+        by_party = {}
+        by_product = {}
+        invoices = set()
+        lines = 0
+        total = Decimal('0.0')
+
+        todo = [i for i in range(count) if prices[i] and days[i] <= to_date]
+        while todo:
+            next_todo = []
+            for i in todo:
+                day = days[i]
+                next_date, quant = billing_period(columns['interval'][i],
+                    columns['interval_quant'][i], lasts[i], day + notice)
+                stop_date = columns['stop_date'][i]
+                if stop_date and next_date > stop_date:
+                    continue
+
+                quantity = Decimal('%f' % (quant * columns['quantity'][i]))
+                if quantity:
+                    amount = quantity * prices[i]
+                    party_id = columns['party'][i]
+                    product_id = columns['product'][i]
+                    by_date[day] = by_date.get(day, 0) + amount
+                    by_party[party_id] = by_party.get(party_id, 0) + amount
+                    by_product[product_id] = by_product.get(product_id, 0) \
+                            + amount
+                    invoices.add((party_id, day))
+                    lines += 1
+                    total += amount
+
+                lasts[i] = next_date
+                days[i] = max(day + one_day, next_date - notice + one_day)
+                if days[i] <= to_date:
+                    next_todo.append(i)
+            todo = next_todo
+
+        return {
+            'total': total,
+            'lines': lines,
+            'invoices': len(invoices),
+            'by_date': sorted(by_date.items()),
+            'by_party': sorted(by_party.items()),
+            'by_product': sorted(by_product.items()),
+        }
+
+Contract()
+
+
+class ForecastInit(ModelView):
+    'Contract Forecast'
+    _name = 'contract.contract.forecast.init'
+    _description = __doc__
+    from_date = fields.Date('From Date', required=True)
+    to_date = fields.Date('To Date', required=True)
+
+    def default_from_date(self):
+        return datetime.date.today()
+
+    def default_to_date(self):
+        return datetime.date.today() + datetime.timedelta(365)
+
+ForecastInit()
+
+
+class ForecastResult(ModelView):
+    'Contract Forecast Result'
+    _name = 'contract.contract.forecast.result'
+    _description = __doc__
+    total = fields.Numeric('Total', digits=(16, 2), readonly=True)
+    invoices = fields.Integer('Invoices', readonly=True)
+    lines = fields.Integer('Invoice Lines', readonly=True)
+    by_product = fields.Text('Per Product', readonly=True)
+
+ForecastResult()
+
+
+class Forecast(Wizard):
+    'Contract Forecast'
+    _name = 'contract.contract.forecast'
+    states = {
+        'init': {
+            'result': {
+                'type': 'form',
+                'object': 'contract.contract.forecast.init',
+                'state': [
+                    ('end', 'Cancel', 'tryton-cancel'),
+                    ('forecast', 'Forecast', 'tryton-ok', True),
+                ],
+            },
+        },
+        'forecast': {
+            'actions': ['_forecast'],
+            'result': {
+                'type': 'form',
+                'object': 'contract.contract.forecast.result',
+                'state': [
+                    ('end', 'Close', 'tryton-ok', True),
+                ],
+            },
+        },
+    }
+
+    def _forecast(self, data):
+        contract_obj = self.pool.get('contract.contract')
+        product_obj = self.pool.get('product.product')
+
+        res = contract_obj.forecast(data['form']['from_date'],
+                                    data['form']['to_date'])
+        names = product_obj.get_rec_name([x[0] for x in res['by_product']],
+                                         'rec_name')
+        return {
+            'total': res['total'],
+            'invoices': res['invoices'],
+            'lines': res['lines'],
+            'by_product': '\n'.join(['%s: %.2f' % (names[product_id], amount)
+                for product_id, amount in res['by_product']]),
+        }
+
+Forecast()
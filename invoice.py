@@ -2,6 +2,9 @@
 from __future__ import with_statement
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.wizard import Wizard
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+from billing import run_in_chunks, CHUNK_SIZE
 
 import logging
 
@@ -12,31 +15,90 @@ class Invoice(ModelSQL, ModelView):
     _name = 'account.invoice'
 
     def set_next_invoice_date(self, ids, trigger_id):
-        """Set next_invoice_date on contracts connected to invoice lines"""
-        invoice_obj = self.pool.get('account.invoice')
+        """Set next_invoice_date on contracts connected to invoice lines
+
+        The contracts billed on the open invoices in ids are collected with
+        one query per IN_MAX invoices and updated together with
+        _write_billing_dates. Contracts whose next_invoice_date already
+        matches their opt_invoice_date are left alone.
+        """
+        cursor = Transaction().cursor
         invoice_line_obj = self.pool.get('account.invoice.line')
         contract_obj = self.pool.get('contract.contract')
 
-        log.debug("set_next_invoice_date %s %s" %(ids, trigger_id))
-        invoices = invoice_obj.browse(ids)
-        for invoice in invoices:
-            for invoice_line in invoice.lines:
-                contract = invoice_line.contract
-                if contract:
-                    next_date = contract.opt_invoice_date
-                    log.debug("set next_invoice_date %s %s" %(contract,
-                                                              next_date))
-                    contract_obj.write(contract.id, {'next_invoice_date': next_date})
+        log.debug("set_next_invoice_date %s %s", ids, trigger_id)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+
+        contract_ids = set()
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('l.invoice', sub_ids)
+            cursor.execute('SELECT DISTINCT l.contract '
+                'FROM "' + invoice_line_obj._table + '" l '
+                'JOIN "' + self._table + '" i ON (i.id = l.invoice) '
+                'WHERE ' + red_sql + ' '
+                    'AND i.state = %s AND i.type = %s '
+                    'AND l.contract IS NOT NULL',
+                red_ids + ['open', 'out_invoice'])
+            contract_ids.update([x[0] for x in cursor.fetchall()])
+
+        dates = {}
+        for contract in contract_obj.read(list(contract_ids),
+                ['opt_invoice_date', 'next_invoice_date']):
+            next_date = contract['opt_invoice_date']
+            if not next_date or next_date == contract['next_invoice_date']:
+                continue
+            dates[contract['id']] = next_date
+
+        log.debug("set next_invoice_date %s", dates)
+        contract_obj._write_billing_dates('next_invoice_date', dates)
         return
 
+    def batch_transition(self, ids, signal, chunk_size=None, commit=True):
+        """
+        Trigger the workflow signal on the invoices in chunks of
+        chunk_size, committing after each chunk when commit is set.
+        Invoices that cannot make the transition are reported instead of
+        aborting the run. As workflow_trigger_validate ignores a signal
+        that does not leave the current state, the states are read before
+        and after each chunk and unchanged invoices are reported as failed.
+
+        returns the counters of billing.run_in_chunks
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+
+        def transition(sub_ids):
+            before = dict([(x['id'], x['state'])
+                for x in self.read(sub_ids, ['state'])])
+            self.workflow_trigger_validate(sub_ids, signal)
+            unchanged = [x['id'] for x in self.read(sub_ids, ['state'])
+                if x['state'] == before[x['id']]]
+            if unchanged:
+                raise ValueError('signal %s does not leave state %s'
+                    % (signal, before[unchanged[0]]))
+
+        log.info("batch transition %s on %d invoices", signal, len(ids))
+        return run_in_chunks(ids, transition, chunk_size=chunk_size,
+                             commit=commit)
+
 Invoice()
 
 class InvoiceLine(ModelSQL, ModelView):
     """Invoice Line"""
     _name = 'account.invoice.line'
 
-    contract = fields.Many2One('contract.contract', 'Contract', readonly=True)
+    def _credit(self, line):
+        """
+        Keep the contract on the credit note lines, so the contract invoice
+        summary nets credited invoices
+        """
+        res = super(InvoiceLine, self)._credit(line)
+        res['contract'] = line.contract.id
+        return res
 
+InvoiceLine()
 
 
 class InvoiceBatchActionInit(ModelView):
@@ -49,9 +111,27 @@ class InvoiceBatchActionInit(ModelView):
         ('open', 'Open'),
         ('cancel','Cancel'),
     ], 'Change Invoice', help='Trigger workflow signal for all selected invoices' )
+    chunk_size = fields.Integer('Chunk Size',
+                                help='Number of invoices changed per commit')
+
+    def default_chunk_size(self):
+        return CHUNK_SIZE
 
 InvoiceBatchActionInit()
 
+class InvoiceBatchActionResult(ModelView):
+    'Invoice Batch Action Result'
+    _name = 'account.invoice.invoice_batch_action.result'
+    _description = __doc__
+    total = fields.Integer('Selected', readonly=True)
+    done = fields.Integer('Changed', readonly=True)
+    failed = fields.Integer('Failed', readonly=True)
+    chunks = fields.Integer('Chunks', readonly=True)
+    elapsed = fields.Float('Seconds', readonly=True, digits=(16, 1))
+    errors = fields.Text('Errors', readonly=True)
+
+InvoiceBatchActionResult()
+
 class InvoiceBatchAction(Wizard):
     'Trigger action on batch of invoices'
     _name='account.invoice.invoice_batch_action'
@@ -71,8 +151,11 @@ class InvoiceBatchAction(Wizard):
         'modify': {
             'actions': ['_batch_action'],
             'result': {
-                'type': 'state',
-                'state': 'end',
+                'type': 'form',
+                'object': 'account.invoice.invoice_batch_action.result',
+                'state': [
+                    ('end', 'Close', 'tryton-ok', True),
+                ],
             },
         },
     }
@@ -85,8 +168,11 @@ class InvoiceBatchAction(Wizard):
             signal = data['form']['signal']
         else:
             return {}
-        for id in data.get('ids'):
-            invoice_obj.workflow_trigger_validate(id, signal)
-        return {}
+        res = invoice_obj.batch_transition(data.get('ids') or [], signal,
+            chunk_size=data['form'].get('chunk_size'))
+        errors = res['errors']
+        res['errors'] = '\n'.join(['%s: %s' % (x, errors[x])
+            for x in sorted(errors.keys())])
+        return res
 
 InvoiceBatchAction()
@@ -1,11 +1,59 @@
 
 from __future__ import with_statement
+from decimal import Decimal
 from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+from contract import contract_unit_price
 
+import datetime
+import time
 import logging
 
 log = logging.getLogger(__name__)
 
+# number of billing periods of one interval per month
+PERIODS_PER_MONTH = {
+    'day': Decimal(365) / 12,
+    'week': Decimal(52) / 12,
+    'month': Decimal(1),
+    'year': Decimal(1) / 12,
+}
+
+OPERATORS = {
+    '=': lambda x, y: x == y,
+    '!=': lambda x, y: x != y,
+    '<': lambda x, y: x is not None and y is not None and x < y,
+    '<=': lambda x, y: x is not None and y is not None and x <= y,
+    '>': lambda x, y: x is not None and y is not None and x > y,
+    '>=': lambda x, y: x is not None and y is not None and x >= y,
+}
+
+def contract_value_sql():
+    """
+    returns the SQL expressions of the unit price, as contract_unit_price
+    computes it, and of the value per month, with PERIODS_PER_MONTH, of a
+    contract aliased c joined to the template of its product aliased t
+    """
+    # the CAST compares Decimal values stored as text by SQLite
+    unit_price = '(CASE WHEN CAST(COALESCE(c.list_price, 0) ' \
+                'AS NUMERIC) != 0 ' \
+            'THEN c.list_price ' \
+            'ELSE t.list_price * (100 - COALESCE(c.discount, 0)) / 100 ' \
+            'END)'
+    periods = '(CASE c."interval" ' + ' '.join(['WHEN \'%s\' THEN %s'
+        % (x, PERIODS_PER_MONTH[x]) for x in sorted(PERIODS_PER_MONTH)]) \
+            + ' ELSE 0 END)'
+    monthly_value = unit_price + ' * c.quantity * ' + periods \
+            + ' / c.interval_quant'
+    return unit_price, monthly_value
+
+SUMMARY_DEFAULTS = {
+    'contract_count': 0,
+    'monthly_value': Decimal('0.00'),
+    'next_due_date': None,
+}
+
 class Party(ModelSQL, ModelView):
     """Party"""
     _name = 'party.party'
@@ -17,6 +65,149 @@ class Party(ModelSQL, ModelView):
                               digits=(4,2),
                              help="""Default Discount percentage on the list_price
                               for this party""")
+    contract_count = fields.Function(fields.Integer('Active Contracts'),
+        'get_contract_summary', searcher='search_contract_summary')
+    monthly_value = fields.Function(fields.Numeric('Monthly Value',
+        digits=(16, 2), help='Recurring value of the active contracts per '
+        'month, metered contracts excluded'), 'get_contract_summary', searcher='search_contract_summary')
+    next_due_date = fields.Function(fields.Date('Next Due Date',
+        help='First next invoice date of the active contracts'),
+        'get_contract_summary', searcher='search_contract_summary')
+
+    def write(self, ids, vals):
+        # companies take their receivable account and payment term from
+        # their party
+        res = super(Party, self).write(ids, vals)
+        self.pool.get('company.company').get_contract_defaults.reset()
+        return res
+
+    def _contract_summary(self, ids=None):
+        """
+        returns a dict mapping the id of each party in ids, or of all
+        parties when ids is None, that has active contracts to a dict with
+        their 'contract_count', 'monthly_value' and 'next_due_date'
+
+        Metered contracts are left out: their value depends on the usage
+        of each period, not on a fixed quantity.
+
+        The contracts are aggregated by one grouped query per IN_MAX
+        parties, on the keys that determine their unit price and interval;
+        the product prices are read once.
+        """
+        cursor = Transaction().cursor
+        contract_obj = self.pool.get('contract.contract')
+        product_obj = self.pool.get('product.product')
+
+        if ids is None:
+            chunks = [None]
+        else:
+            chunks = [ids[i:i + cursor.IN_MAX]
+                      for i in range(0, len(ids), cursor.IN_MAX)]
+        rows = []
+        for sub_ids in chunks:
+            sql = 'SELECT party, product, list_price, discount, ' \
+                    '"interval", interval_quant, SUM(quantity), COUNT(id), ' \
+                    'MIN(COALESCE(next_invoice_date, start_date)) ' \
+                'FROM "' + contract_obj._table + '" ' \
+                'WHERE state = %s AND metered = %s'
+            args = ['active', False]
+            if sub_ids is not None:
+                red_sql, red_ids = reduce_ids('party', sub_ids)
+                sql += ' AND ' + red_sql
+                args += red_ids
+            cursor.execute(sql + ' GROUP BY party, product, list_price, '
+                'discount, "interval", interval_quant', args)
+            rows.extend(cursor.fetchall())
+
+        product_prices = {}
+        for product in product_obj.read(list(set([x[1] for x in rows])),
+                ['list_price']):
+            product_prices[product['id']] = product['list_price']
+
+        res = {}
+        for (party_id, product_id, list_price, discount, interval,
+                interval_quant, quantity, count, due_date) in rows:
+            summary = res.setdefault(party_id, SUMMARY_DEFAULTS.copy())
+            summary['contract_count'] += count
+            if isinstance(due_date, basestring):
+                due_date = datetime.date(*time.strptime(due_date,
+                    '%Y-%m-%d')[:3])
+            if due_date and (not summary['next_due_date']
+                    or due_date < summary['next_due_date']):
+                summary['next_due_date'] = due_date
+            if not interval_quant or interval not in PERIODS_PER_MONTH:
+                continue
+            unit_price = contract_unit_price(product_prices[product_id],
+                list_price and Decimal(str(list_price)),
+                discount and Decimal(str(discount)))
+            if not unit_price:
+                continue
+            summary['monthly_value'] += unit_price \
+                    * Decimal(str(quantity or 0)) \
+                    * PERIODS_PER_MONTH[interval] / interval_quant
+        for summary in res.values():
+            summary['monthly_value'] = summary['monthly_value'].quantize(
+                Decimal('0.01'))
+        return res
+
+    def get_contract_summary(self, ids, names):
+        summary = self._contract_summary(ids)
+        res = {}
+        for name in names:
+            res[name] = {}
+            for party_id in ids:
+                res[name][party_id] = summary.get(party_id,
+                    SUMMARY_DEFAULTS)[name]
+        return res
+
+    def search_contract_summary(self, name, clause):
+        """
+        Search on the summary of the active contracts with one query
+        grouped per party, comparing the summary in its HAVING clause.
+        The parties without active contracts match as their default
+        summary does.
+        """
+        contract_obj = self.pool.get('contract.contract')
+        product_obj = self.pool.get('product.product')
+        template_obj = self.pool.get('product.template')
+
+        operator, value = clause[1], clause[2]
+        if operator not in OPERATORS:
+            return [('id', '=', 0)]
+        unit_price, monthly_value = contract_value_sql()
+        column = {
+            'contract_count': 'COUNT(c.id)',
+            'monthly_value': 'ROUND(CAST(SUM(CASE '
+                    'WHEN c.interval_quant > 0 '
+                    'THEN ' + monthly_value + ' ELSE 0 END) AS NUMERIC), 2)',
+            'next_due_date': 'MIN(COALESCE(c.next_invoice_date, '
+                'c.start_date))',
+        }[name]
+
+        args = ['active', False]
+        if value is None:
+            if operator not in ('=', '!='):
+                return [('id', '=', 0)]
+            condition = column + (operator == '=' and ' IS NULL'
+                or ' IS NOT NULL')
+        elif name == 'monthly_value':
+            condition = column + ' ' + operator + ' CAST(%s AS NUMERIC)'
+            args.append(str(value))
+        else:
+            condition = column + ' ' + operator + ' %s'
+            args.append(value)
+
+        sql = 'SELECT c.party ' \
+            'FROM "' + contract_obj._table + '" c ' \
+            'JOIN "' + product_obj._table + '" p ON (p.id = c.product) ' \
+            'JOIN "' + template_obj._table + '" t ON (t.id = p.template) ' \
+            'WHERE c.state = %s ' \
+                'AND c.metered = %s ' \
+            'GROUP BY c.party '
+        if OPERATORS[operator](SUMMARY_DEFAULTS[name], value):
+            return [('id', 'notinselect', (sql + 'HAVING CASE '
+                'WHEN ' + condition + ' THEN 1 ELSE 0 END = 0', args))]
+        return [('id', 'inselect', (sql + 'HAVING ' + condition, args))]
 
 Party()
 
@@ -0,0 +1,329 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from decimal import Decimal
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pyson import Eval, Not, Equal
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+from contract import contract_unit_price
+
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+STATES = {
+    'readonly': Not(Equal(Eval('state'), 'draft')),
+}
+
+
+class PriceIndex(ModelSQL, ModelView):
+    'Contract Price Index'
+    _name = 'contract.price_index'
+    _description = __doc__
+
+    name = fields.Char('Name', required=True, states=STATES)
+    date = fields.Date('Effective Date', required=True, states=STATES,
+                       help='The prices change on this date')
+    method = fields.Selection([
+        ('percentage', 'Percentage'),
+        ('absolute', 'Absolute'),
+    ], 'Method', required=True, states=STATES)
+    value = fields.Numeric('Value', digits=(16, 4), required=True,
+                           states=STATES,
+                           help='Percentage or amount added to the price')
+    product = fields.Many2One('product.product', 'Product', states=STATES,
+                              help='Only index contracts on this product')
+    party = fields.Many2One('party.party', 'Party', states=STATES,
+                            help='Only index contracts of this party')
+    contract_state = fields.Selection([
+        ('', ''),
+        ('draft', 'Draft'),
+        ('active', 'Active'),
+        ('hold', 'Hold'),
+    ], 'Contract State', states=STATES,
+        help='Only index contracts in this state')
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('waiting', 'Waiting'),
+        ('applied', 'Applied'),
+        ('reverted', 'Reverted'),
+    ], 'State', required=True, readonly=True)
+    lines = fields.One2Many('contract.price_index.line', 'price_index',
+                            'Lines', readonly=True)
+
+    def __init__(self):
+        super(PriceIndex, self).__init__()
+        self._order.insert(0, ('date', 'DESC'))
+        self._rpc.update({
+            'preview': True,
+            'apply': True,
+            'revert': True,
+        })
+        self._error_messages.update({
+            'delete_applied': 'You can not delete a price index that is '
+                'applied!',
+        })
+
+    def default_date(self):
+        return datetime.date.today()
+
+    def default_method(self):
+        return 'percentage'
+
+    def default_value(self):
+        return Decimal('0.0')
+
+    def default_contract_state(self):
+        return 'active'
+
+    def default_state(self):
+        return 'draft'
+
+    def delete(self, ids):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        for index in self.browse(ids):
+            if index.state == 'applied':
+                self.raise_user_error('delete_applied')
+        return super(PriceIndex, self).delete(ids)
+
+    def _contract_domain(self, index):
+        domain = [('state', '!=', 'canceled')]
+        if index.contract_state:
+            domain.append(('state', '=', index.contract_state))
+        if index.product:
+            domain.append(('product', '=', index.product.id))
+        if index.party:
+            domain.append(('party', '=', index.party.id))
+        return domain
+
+    def _new_price(self, index, price):
+        if index.method == 'percentage':
+            price = price * (1 + index.value / 100)
+        else:
+            price = price + index.value
+        return price.quantize(Decimal('0.0001'))
+
+    def _compute_lines(self, index):
+        """
+        Replace the lines of index by the old and new list price of each
+        contract it selects.
+
+        The new list price override is the indexed unit price of the
+        contract, so the discount of contracts without override is kept in
+        the new price (an override takes precedence over the discount).
+        Contracts billed at a zero unit price are left out. The lines are
+        written with one INSERT per distinct new price and IN_MAX
+        contracts.
+
+        returns the number of contracts indexed
+        """
+        cursor = Transaction().cursor
+        contract_obj = self.pool.get('contract.contract')
+        product_obj = self.pool.get('product.product')
+        line_obj = self.pool.get('contract.price_index.line')
+
+        cursor.execute('DELETE FROM "' + line_obj._table + '" '
+            'WHERE price_index = %s', (index.id,))
+
+        contract_ids = contract_obj.search(self._contract_domain(index))
+        contracts = contract_obj.read(contract_ids,
+                                      ['list_price', 'discount', 'product'])
+        product_prices = {}
+        for product in product_obj.read(list(set([x['product']
+                        for x in contracts])), ['list_price']):
+            product_prices[product['id']] = product['list_price']
+
+        by_price = {}
+        count = 0
+        for contract in contracts:
+            price = contract_unit_price(product_prices[contract['product']],
+                contract['list_price'], contract['discount'])
+            if not price:
+                continue
+            new_price = self._new_price(index, price)
+            by_price.setdefault(new_price, []).append(contract['id'])
+            count += 1
+
+        now = datetime.datetime.now()
+        for new_price, ids in by_price.items():
+            for i in range(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                red_sql, red_ids = reduce_ids('id', sub_ids)
+                cursor.execute('INSERT INTO "' + line_obj._table + '" '
+                    '(create_uid, create_date, price_index, contract, '
+                        'old_list_price, new_list_price) '
+                    'SELECT %s, %s, %s, id, list_price, %s '
+                    'FROM "' + contract_obj._table + '" '
+                    'WHERE ' + red_sql,
+                    [Transaction().user, now, index.id, new_price] + red_ids)
+        return count
+
+    def preview(self, ids):
+        """
+        Fill the lines of the draft indexes with the prices they would set,
+        without changing the contracts
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        for index in self.browse(ids):
+            if index.state == 'draft':
+                self._compute_lines(index)
+        return {}
+
+    def _index_contracts(self, index):
+        """
+        returns the ids of the contracts with a line on index
+        """
+        cursor = Transaction().cursor
+        line_obj = self.pool.get('contract.price_index.line')
+        cursor.execute('SELECT contract FROM "' + line_obj._table + '" '
+            'WHERE price_index = %s', (index.id,))
+        return [x[0] for x in cursor.fetchall()]
+
+    def apply(self, ids):
+        """
+        Apply the indexes whose effective date is reached, the others wait
+        for the cron. The lines are recomputed and the contract list
+        prices are set from them with a single UPDATE per index, which
+        sets write_uid and write_date and clears the cursor cache of the
+        contracts as write does.
+        """
+        cursor = Transaction().cursor
+        contract_obj = self.pool.get('contract.contract')
+        line_obj = self.pool.get('contract.price_index.line')
+
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        today = datetime.date.today()
+        for index in self.browse(ids):
+            if index.state not in ('draft', 'waiting'):
+                continue
+            if index.date > today:
+                self.write(index.id, {'state': 'waiting'})
+                continue
+
+            count = self._compute_lines(index)
+            cursor.execute('UPDATE "' + contract_obj._table + '" '
+                'SET list_price = (SELECT l.new_list_price '
+                        'FROM "' + line_obj._table + '" l '
+                        'WHERE l.contract = "' + contract_obj._table + '".id '
+                            'AND l.price_index = %s), '
+                    'write_uid = %s, write_date = %s '
+                'WHERE id IN (SELECT contract '
+                    'FROM "' + line_obj._table + '" '
+                    'WHERE price_index = %s)',
+                (index.id, Transaction().user, datetime.datetime.now(),
+                    index.id))
+            contract_obj._clear_cursor_cache(self._index_contracts(index))
+            self.write(index.id, {'state': 'applied'})
+            log.info('price index %s applied to %d contracts', index.id,
+                     count)
+        return {}
+
+    def revert(self, ids):
+        """
+        Put back the list prices from before the applied indexes with a
+        single UPDATE per index. Contracts whose list price changed since
+        the index was applied are left alone.
+        """
+        cursor = Transaction().cursor
+        contract_obj = self.pool.get('contract.contract')
+        line_obj = self.pool.get('contract.price_index.line')
+
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        for index in self.browse(ids):
+            if index.state != 'applied':
+                continue
+            cursor.execute('UPDATE "' + contract_obj._table + '" '
+                'SET list_price = (SELECT l.old_list_price '
+                        'FROM "' + line_obj._table + '" l '
+                        'WHERE l.contract = "' + contract_obj._table + '".id '
+                            'AND l.price_index = %s), '
+                    'write_uid = %s, write_date = %s '
+                'WHERE id IN (SELECT contract '
+                    'FROM "' + line_obj._table + '" '
+                    'WHERE price_index = %s '
+                        'AND new_list_price = "'
+                            + contract_obj._table + '".list_price)',
+                (index.id, Transaction().user, datetime.datetime.now(),
+                    index.id))
+            count = cursor.rowcount
+            contract_obj._clear_cursor_cache(self._index_contracts(index))
+            self.write(index.id, {'state': 'reverted'})
+            log.info('price index %s reverted on %d contracts', index.id,
+                     count)
+        return {}
+
+    def apply_waiting(self):
+        """
+        Apply the waiting indexes whose effective date is reached, called
+        by the cron
+        """
+        self.apply(self.search([
+            ('state', '=', 'waiting'),
+            ('date', '<=', datetime.date.today()),
+        ], order=[('date', 'ASC'), ('id', 'ASC')]))
+
+    def index_prices(self, name, method, value, date=None, product=None,
+            party=None, contract_state='active'):
+        """
+        Create and apply a price index in one call
+
+        returns the id of the index
+        """
+        index_id = self.create({
+            'name': name,
+            'method': method,
+            'value': value,
+            'date': date or datetime.date.today(),
+            'product': product or False,
+            'party': party or False,
+            'contract_state': contract_state or '',
+        })
+        self.apply([index_id])
+        return index_id
+
+PriceIndex()
+
+
+class PriceIndexLine(ModelSQL, ModelView):
+    'Contract Price Index Line'
+    _name = 'contract.price_index.line'
+    _description = __doc__
+    _rec_name = 'contract'
+
+    price_index = fields.Many2One('contract.price_index', 'Price Index',
+                                  required=True, select=1,
+                                  ondelete='CASCADE', readonly=True)
+    contract = fields.Many2One('contract.contract', 'Contract', required=True,
+                               select=1, ondelete='CASCADE', readonly=True)
+    old_list_price = fields.Numeric('Old List Price', digits=(16, 4),
+                                    readonly=True)
+    new_list_price = fields.Numeric('New List Price', digits=(16, 4),
+                                    readonly=True)
+    old_unit_price = fields.Function(fields.Numeric('Old Unit Price',
+        digits=(16, 4)), 'get_unit_price')
+    new_unit_price = fields.Function(fields.Numeric('New Unit Price',
+        digits=(16, 4)), 'get_unit_price')
+
+    def get_unit_price(self, ids, names):
+        """
+        returns the unit prices before and after the index, as computed by
+        _contract_unit_price with the discount of the contract
+        """
+        res = {}
+        for name in names:
+            res[name] = {}
+        for line in self.browse(ids):
+            contract = line.contract
+            for name in names:
+                list_price = line[name.replace('unit', 'list')]
+                res[name][line.id] = contract_unit_price(
+                    contract.product.list_price, list_price,
+                    contract.discount)
+        return res
+
+PriceIndexLine()
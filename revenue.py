@@ -0,0 +1,208 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from decimal import Decimal
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from party import contract_value_sql
+from dateutil.relativedelta import relativedelta
+
+import datetime
+
+# columns summarize can group the recurring revenue on
+GROUP_COLUMNS = [
+    'company',
+    'party',
+    'product',
+    'interval',
+    'start_month',
+]
+
+
+class Revenue(ModelSQL, ModelView):
+    'Contract Recurring Revenue'
+    _name = 'contract.revenue'
+    _description = __doc__
+    _rec_name = 'contract'
+
+    contract = fields.Many2One('contract.contract', 'Contract', readonly=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    product = fields.Many2One('product.product', 'Product', readonly=True)
+    interval = fields.Selection([
+        ('day', 'Day'),
+        ('week', 'Week'),
+        ('month', 'Month'),
+        ('year', 'Year'),
+    ], 'Interval', readonly=True)
+    interval_quant = fields.Integer('Interval count', readonly=True)
+    quantity = fields.Numeric('Quantity', digits=(16, 2), readonly=True)
+    start_date = fields.Date('Start date', readonly=True)
+    stop_date = fields.Date('Stop date', readonly=True)
+    start_month = fields.Char('Start month', readonly=True,
+                              help='Month the contract started, as YYYY-MM')
+    unit_price = fields.Numeric('Unit Price', digits=(16, 4), readonly=True)
+    monthly_value = fields.Numeric('MRR', digits=(16, 2), readonly=True,
+                                   help='Monthly recurring revenue')
+    annual_value = fields.Numeric('ARR', digits=(16, 2), readonly=True,
+                                  help='Annual recurring revenue')
+
+    def __init__(self):
+        super(Revenue, self).__init__()
+        self._order.insert(0, ('monthly_value', 'DESC'))
+        self._rpc.update({
+            'summarize': False,
+            'summarize_months': False,
+        })
+
+    def table_query(self):
+        """
+        One row per active contract, with the unit price of
+        contract_unit_price and its value normalized to a month and a year
+        with PERIODS_PER_MONTH, all computed in SQL by contract_value_sql.
+        Metered contracts are left out, their value depends on their usage.
+
+        The row id is the contract id.
+        """
+        contract_obj = self.pool.get('contract.contract')
+        product_obj = self.pool.get('product.product')
+        template_obj = self.pool.get('product.template')
+
+        unit_price, monthly_value = contract_value_sql()
+        if CONFIG['db_type'] == 'sqlite':
+            start_month = 'strftime(%s, c.start_date)'
+            month_format = '%Y-%m'
+        else:
+            start_month = 'to_char(c.start_date, %s)'
+            month_format = 'YYYY-MM'
+
+        return ('SELECT c.id AS id, c.create_uid AS create_uid, '
+                'c.create_date AS create_date, c.write_uid AS write_uid, '
+                'c.write_date AS write_date, c.id AS contract, '
+                'c.company AS company, c.party AS party, '
+                'c.product AS product, c."interval" AS "interval", '
+                'c.interval_quant AS interval_quant, '
+                'c.quantity AS quantity, c.start_date AS start_date, '
+                'c.stop_date AS stop_date, '
+                + start_month + ' AS start_month, '
+                + unit_price + ' AS unit_price, '
+                + monthly_value + ' AS monthly_value, '
+                + monthly_value + ' * 12 AS annual_value '
+            'FROM "' + contract_obj._table + '" c '
+            'JOIN "' + product_obj._table + '" p ON (p.id = c.product) '
+            'JOIN "' + template_obj._table + '" t ON (t.id = p.template) '
+            'WHERE c.state = %s AND c.interval_quant > 0 '
+                'AND c.metered = %s',
+            [month_format, 'active', False])
+
+    def _group_columns(self, group_by):
+        """
+        returns group_by as a list, checked against GROUP_COLUMNS, and the
+        SQL list of its columns on the rows aliased r
+        """
+        if isinstance(group_by, basestring):
+            group_by = [group_by]
+        for name in group_by:
+            if name not in GROUP_COLUMNS:
+                raise ValueError('Can not group recurring revenue on %r'
+                                 % name)
+        return group_by, ', '.join(['r."%s"' % x for x in group_by])
+
+    def _summary_rows(self, names, rows):
+        """
+        returns the rows ending on the count, monthly_value and
+        annual_value sums as dicts keyed on names and these
+        """
+        res = []
+        for row in rows:
+            values = dict(zip(names, row))
+            count, monthly_value, annual_value = row[len(names):]
+            values['count'] = count
+            values['monthly_value'] = Decimal(str(monthly_value or 0)
+                ).quantize(Decimal('0.01'))
+            values['annual_value'] = Decimal(str(annual_value or 0)
+                ).quantize(Decimal('0.01'))
+            res.append(values)
+        return res
+
+    def summarize(self, group_by, domain=None):
+        """
+        Sum the recurring revenue of the rows matching domain grouped on
+        the GROUP_COLUMNS in group_by, with one GROUP BY query
+
+        returns a list of dicts with the group_by columns, the 'count' of
+        contracts and their 'monthly_value' and 'annual_value', sorted on
+        the group_by columns
+        """
+        cursor = Transaction().cursor
+
+        group_by, columns = self._group_columns(group_by)
+        query, query_args = self.table_query()
+        sql = 'SELECT ' + (columns and columns + ', ' or '') \
+                + 'COUNT(r.id), SUM(r.monthly_value), ' \
+                    'SUM(r.annual_value) ' \
+                'FROM (' + query + ') AS r'
+        args = list(query_args)
+        if domain:
+            search_query, search_args = self.search(domain, order=[],
+                                                    query_string=True)
+            sql += ' WHERE r.id IN (' + search_query + ')'
+            args += search_args
+        if columns:
+            sql += ' GROUP BY ' + columns + ' ORDER BY ' + columns
+        cursor.execute(sql, args)
+        return self._summary_rows(group_by, cursor.fetchall())
+
+    def summarize_months(self, from_date, to_date, group_by=None,
+            domain=None):
+        """
+        Sum the recurring revenue per calendar month, from the month of
+        from_date to the month of to_date, of the rows matching domain,
+        also grouped on the GROUP_COLUMNS in group_by, with one query.
+
+        A contract counts in every month it runs in: it starts on or
+        before the last day of the month and does not stop before its
+        first day. The rows are the active contracts, so months in the
+        past leave out the contracts that have been canceled since.
+
+        returns a list of dicts with the 'month' as YYYY-MM, the group_by
+        columns, the 'count' of contracts and their 'monthly_value' and
+        'annual_value', sorted on the month and the group_by columns
+        """
+        cursor = Transaction().cursor
+
+        group_by, columns = self._group_columns(group_by or [])
+        months = []
+        month_args = []
+        first_day = datetime.date(from_date.year, from_date.month, 1)
+        while first_day <= to_date:
+            next_month = first_day + relativedelta(months=1)
+            months.append('SELECT %s AS month, %s AS first_day, '
+                '%s AS last_day')
+            month_args += [first_day.strftime('%Y-%m'), first_day,
+                next_month - datetime.timedelta(1)]
+            first_day = next_month
+        if not months:
+            return []
+
+        group_columns = 'm.month' + (columns and ', ' + columns or '')
+        query, query_args = self.table_query()
+        sql = 'SELECT ' + group_columns + ', COUNT(r.id), ' \
+                    'SUM(r.monthly_value), SUM(r.annual_value) ' \
+                'FROM (' + query + ') AS r ' \
+                'JOIN (' + ' UNION ALL '.join(months) + ') AS m ' \
+                    'ON ((r.start_date IS NULL ' \
+                            'OR r.start_date <= m.last_day) ' \
+                        'AND (r.stop_date IS NULL ' \
+                            'OR r.stop_date >= m.first_day))'
+        args = list(query_args) + month_args
+        if domain:
+            search_query, search_args = self.search(domain, order=[],
+                                                    query_string=True)
+            sql += ' WHERE r.id IN (' + search_query + ')'
+            args += search_args
+        sql += ' GROUP BY ' + group_columns + ' ORDER BY ' + group_columns
+        cursor.execute(sql, args)
+        return self._summary_rows(['month'] + group_by, cursor.fetchall())
+
+Revenue()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"""
+Benchmark the contract billing entry points.
+
+For each scale (number of parties and contracts) a synthetic data set is
+generated on top of a billing fixture and the wall time of
+create_invoice_batch, _check_contract, set_next_invoice_date and
+cancel_with_credit is measured. Every scale runs in its own transaction
+that is rolled back afterwards.
+
+The database is the one of trytond.tests.test_tryton: SQLite in memory,
+or PostgreSQL when the trytond configuration says so.
+
+    benchmark_contract.py --scale 10:100 --scale 100:1000 \\
+        --output results.json --baseline baseline.json
+
+The results are written as JSON. With --baseline, each timing is compared
+to the same scale and entry point of a previous result file and the script
+exits with status 1 when one is slower than the baseline by more than the
+tolerance.
+"""
+from __future__ import with_statement
+
+import sys, os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import datetime
+import random
+import time
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, \
+        install_module
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond.modules.contract.tests.scenario import create_fixture, \
+        generate_contracts
+
+ENTRY_POINTS = [
+    '_check_contract',
+    'create_invoice_batch',
+    'set_next_invoice_date',
+    'cancel_with_credit',
+]
+
+# share of the contracts canceled in the cancel_with_credit benchmark
+CANCEL_RATIO = 0.1
+
+
+def timed(timings, name, function, *args):
+    start = time.time()
+    res = function(*args)
+    timings[name] = time.time() - start
+    return res
+
+
+def setup(today):
+    """
+    Install the modules and create the billing fixture
+
+    returns the fixture
+    """
+    install_module('contract')
+    # the product accounts and taxes used on invoice lines come from
+    # account_product
+    install_module('account_product')
+    with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+        fixture = create_fixture(today)
+        transaction.cursor.commit()
+    return fixture
+
+
+def run_scale(fixture, parties, contracts, today, seed):
+    """
+    Generate parties and contracts and time the entry points on them
+
+    returns a dict with the scale, the 'timings' in seconds per entry
+    point and the 'counts' of the records involved
+    """
+    contract_obj = POOL.get('contract.contract')
+    invoice_obj = POOL.get('account.invoice')
+
+    timings = {}
+    counts = {}
+    with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+        with transaction.set_context(company=fixture['company']):
+            contract_ids = generate_contracts(fixture, parties, contracts,
+                                              today=today, seed=seed)
+
+            def check_contracts():
+                return [contract_obj._check_contract(x, today)
+                        for x in contract_obj.browse(contract_ids)]
+            periods = timed(timings, '_check_contract', check_contracts)
+            counts['due'] = len([x for x in periods if x])
+
+            invoice_ids = timed(timings, 'create_invoice_batch',
+                                contract_obj.create_invoice_batch, None,
+                                {'form': {'invoice_date': today}})
+            counts['invoices'] = len(invoice_ids)
+
+            # Opening the invoices already moves next_invoice_date through
+            # the trigger, put the dates back to time the handler alone.
+            dates = {}
+            for values in contract_obj.read(contract_ids,
+                    ['next_invoice_date']):
+                dates.setdefault(values['next_invoice_date'], []).append(
+                    values['id'])
+            invoice_obj.workflow_trigger_validate(invoice_ids, 'open')
+            for date, date_contract_ids in dates.items():
+                contract_obj.write(date_contract_ids,
+                                   {'next_invoice_date': date})
+            timed(timings, 'set_next_invoice_date',
+                  invoice_obj.set_next_invoice_date, invoice_ids, None)
+
+            cancel_ids = random.Random(seed).sample(contract_ids,
+                int(len(contract_ids) * CANCEL_RATIO) or 1)
+            res = timed(timings, 'cancel_with_credit',
+                        contract_obj.cancel_with_credit, cancel_ids)
+            counts['canceled'] = len([x for x in res.values()
+                                      if x['result'] == 'canceled'])
+            credit_ids = set()
+            for values in res.values():
+                credit_ids.update(values['credits'])
+            counts['credits'] = len(credit_ids)
+
+        transaction.cursor.rollback()
+
+    return {
+        'parties': parties,
+        'contracts': contracts,
+        'timings': timings,
+        'counts': counts,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with baseline, matching them on scale and entry point
+
+    returns the list of (scale, entry point, baseline, current) tuples
+    that are slower than the baseline by more than tolerance
+    """
+    previous = {}
+    for result in baseline['results']:
+        previous[(result['parties'], result['contracts'])] = \
+                result['timings']
+
+    regressions = []
+    for result in results['results']:
+        scale = (result['parties'], result['contracts'])
+        if scale not in previous:
+            continue
+        for name in ENTRY_POINTS:
+            before = previous[scale].get(name)
+            current = result['timings'].get(name)
+            if before is None or current is None:
+                continue
+            ratio = current / max(before, 1e-6)
+            flag = ''
+            if ratio > 1 + tolerance:
+                regressions.append((scale, name, before, current))
+                flag = ' REGRESSION'
+            sys.stdout.write('%6d:%-7d %-22s %8.3fs %8.3fs %6.2fx%s\n'
+                % (scale[0], scale[1], name, before, current, ratio, flag))
+    return regressions
+
+
+def parse_scale(option, opt_str, value, parser):
+    try:
+        parties, contracts = [int(x) for x in value.split(':')]
+    except ValueError:
+        parser.error('%s expects PARTIES:CONTRACTS, got %r'
+                     % (opt_str, value))
+    parser.values.scales.append((parties, contracts))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--scale', action='callback', callback=parse_scale,
+                      type='string', dest='scales', default=[],
+                      help='number of parties and contracts as '
+                      'PARTIES:CONTRACTS, may be repeated')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed of the data generator')
+    parser.add_option('--output', help='write the results to this file')
+    parser.add_option('--baseline',
+                      help='compare the results with this result file')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='allowed slowdown against the baseline '
+                      '(default: 0.2)')
+    options, args = parser.parse_args()
+    scales = options.scales or [(10, 100), (100, 1000)]
+
+    today = datetime.date.today()
+    fixture = setup(today)
+
+    results = {
+        'db_type': CONFIG['db_type'],
+        'date': str(today),
+        'seed': options.seed,
+        'results': [],
+    }
+    for parties, contracts in scales:
+        result = run_scale(fixture, parties, contracts, today, options.seed)
+        results['results'].append(result)
+        for name in ENTRY_POINTS:
+            sys.stdout.write('%6d:%-7d %-22s %8.3fs\n' % (parties,
+                contracts, name, result['timings'][name]))
+
+    if options.output:
+        output = open(options.output, 'w')
+        try:
+            json.dump(results, output, indent=2, sort_keys=True)
+        finally:
+            output.close()
+
+    if options.baseline:
+        baseline_file = open(options.baseline)
+        try:
+            baseline = json.load(baseline_file)
+        finally:
+            baseline_file.close()
+        if compare(results, baseline, options.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
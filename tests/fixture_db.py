@@ -0,0 +1,180 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"""
+Template databases for the contract billing tests.
+
+FixtureDatabase builds a database with the modules installed and the
+billing fixture of scenario.create_fixture once per process, and keeps it
+as a template. Each test then gets a fresh clone of it: a copy of the
+SQLite file, or a PostgreSQL database created with the template as
+TEMPLATE. Installing the modules and creating the accounting only happens
+once, so a test only pays for the copy.
+
+    FIXTURE_DB = FixtureDatabase()
+
+    class BillingTestCase(unittest.TestCase):
+
+        def setUp(self):
+            self.database_name, self.fixture = FIXTURE_DB.clone()
+
+        def tearDown(self):
+            FIXTURE_DB.drop()
+
+The clone is always created under the same name, so the pool of its
+database is only loaded once.
+"""
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import time
+import datetime
+import atexit
+
+from trytond.config import CONFIG
+from trytond.backend import Database
+from trytond.cache import Cache
+from trytond.pool import Pool
+from trytond.protocols.dispatcher import create
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import USER, USER_PASSWORD, CONTEXT
+from trytond.modules.contract.tests.scenario import create_fixture
+
+MODULES = [
+    'contract',
+    # the product accounts and taxes used on invoice lines come from
+    # account_product
+    'account_product',
+]
+
+
+def install_modules(database_name, names):
+    """
+    Install the modules in names and their dependencies on database_name,
+    as trytond.tests.test_tryton.install_module does for the test database
+    """
+    pool = Pool(database_name)
+    with Transaction().start(database_name, USER, CONTEXT) as transaction:
+        module_obj = pool.get('ir.module.module')
+        module_ids = module_obj.search([
+            ('name', 'in', names),
+            ('state', '!=', 'installed'),
+        ])
+        if not module_ids:
+            return
+        module_obj.button_install(module_ids)
+        transaction.cursor.commit()
+
+        install_upgrade_obj = pool.get('ir.module.module.install_upgrade',
+                                       type='wizard')
+        wiz_id = install_upgrade_obj.create()
+        transaction.cursor.commit()
+        install_upgrade_obj.execute(wiz_id, {}, 'start')
+        transaction.cursor.commit()
+        install_upgrade_obj.delete(wiz_id)
+        transaction.cursor.commit()
+
+
+class FixtureDatabase(object):
+    """
+    A template database holding the billing fixture and its clone
+    """
+
+    def __init__(self, modules=None, today=None, prefix='test_contract'):
+        self.modules = modules or MODULES
+        self.today = today or datetime.date.today()
+        suffix = str(int(time.time()))
+        self.template_name = '%s_template_%s' % (prefix, suffix)
+        self.clone_name = '%s_clone_%s' % (prefix, suffix)
+        self.fixture = None
+        self._cloned = False
+        self._pool_loaded = False
+
+    def _sqlite_path(self, database_name):
+        return os.path.join(CONFIG['data_path'], database_name + '.sqlite')
+
+    def build(self):
+        """
+        Create the template database with the modules and the fixture,
+        once
+
+        returns the fixture dict of create_fixture
+        """
+        if self.fixture is not None:
+            return self.fixture
+
+        if CONFIG['db_type'] == 'sqlite':
+            # keep the template and its clones out of the real data path
+            CONFIG['data_path'] = tempfile.mkdtemp(prefix='test_contract')
+            atexit.register(shutil.rmtree, CONFIG['data_path'], True)
+        else:
+            atexit.register(self._drop_database, self.template_name)
+            atexit.register(self.drop)
+
+        create(self.template_name, CONFIG['admin_passwd'], 'en_US',
+               USER_PASSWORD)
+        install_modules(self.template_name, self.modules)
+        with Transaction().start(self.template_name, USER,
+                CONTEXT) as transaction:
+            fixture = create_fixture(self.today)
+            transaction.cursor.commit()
+        # PostgreSQL refuses to copy a database with open connections
+        Database(self.template_name).close()
+        self.fixture = fixture
+        return fixture
+
+    def _drop_database(self, database_name):
+        Database(database_name).close()
+        database = Database().connect()
+        cursor = database.cursor(autocommit=True)
+        try:
+            database.drop(cursor, database_name)
+            cursor.commit()
+        finally:
+            cursor.close(close=True)
+
+    def clone(self):
+        """
+        Replace the clone database by a fresh copy of the template, which
+        is built first if needed
+
+        returns the (database name, fixture) tuple of the clone
+        """
+        fixture = self.build()
+        if self._cloned:
+            self.drop()
+
+        if CONFIG['db_type'] == 'sqlite':
+            shutil.copyfile(self._sqlite_path(self.template_name),
+                            self._sqlite_path(self.clone_name))
+        else:
+            database = Database().connect()
+            cursor = database.cursor(autocommit=True)
+            try:
+                cursor.execute('CREATE DATABASE "' + self.clone_name + '" '
+                    'TEMPLATE "' + self.template_name + '"')
+                cursor.commit()
+            finally:
+                cursor.close(close=True)
+        self._cloned = True
+
+        # the cached values of the previous clone are stale
+        for cache in Cache._cache_instance:
+            cache._cache[self.clone_name] = {}
+        if not self._pool_loaded:
+            Pool(self.clone_name).init()
+            self._pool_loaded = True
+        return (self.clone_name, fixture)
+
+    def drop(self):
+        """
+        Drop the clone database
+        """
+        if not self._cloned:
+            return
+        if CONFIG['db_type'] == 'sqlite':
+            os.remove(self._sqlite_path(self.clone_name))
+        else:
+            self._drop_database(self.clone_name)
+        self._cloned = False
@@ -0,0 +1,254 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"""
+Synthetic billing data for the contract tests and benchmarks.
+
+create_fixture sets up the accounting a contract needs to be invoiced
+(company, accounts, fiscal year, taxes, tax rules, payment term and
+products), generate_contracts adds parties with active contracts on top of
+it. Both must run inside a transaction, on the pool of its database.
+"""
+from __future__ import with_statement
+from decimal import Decimal
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.tests.test_tryton import USER
+
+import datetime
+import random
+
+# (interval, interval_quant) pairs the generator draws from
+INTERVALS = [
+    ('day', 1),
+    ('day', 14),
+    ('week', 1),
+    ('week', 4),
+    ('month', 1),
+    ('month', 1),
+    ('month', 1),
+    ('month', 3),
+    ('year', 1),
+]
+
+DISCOUNTS = ['0.0', '0.0', '0.0', '5.0', '10.0', '25.0', '100.0']
+
+
+def create_fixture(today=None, products=5):
+    """
+    Create a company with everything needed to invoice contracts at
+    today: currency, receivable and revenue accounts, a fiscal year with
+    its periods and sequences, a tax and a tax rule substituting it, a
+    payment term and products.
+
+    The user is moved into the new company.
+
+    returns a dict with the ids of the 'company', 'journal',
+    'payment_term', 'receivable', 'products' and 'tax_rules'
+    """
+    today = today or datetime.date.today()
+    pool = Pool(Transaction().cursor.database_name)
+    currency_obj = pool.get('currency.currency')
+    company_obj = pool.get('company.company')
+    user_obj = pool.get('res.user')
+    account_type_obj = pool.get('account.account.type')
+    account_obj = pool.get('account.account')
+    journal_obj = pool.get('account.journal')
+    sequence_obj = pool.get('ir.sequence')
+    sequence_strict_obj = pool.get('ir.sequence.strict')
+    fiscalyear_obj = pool.get('account.fiscalyear')
+    tax_obj = pool.get('account.tax')
+    tax_rule_obj = pool.get('account.tax.rule')
+    payment_term_obj = pool.get('account.invoice.payment_term')
+    category_obj = pool.get('product.category')
+    uom_obj = pool.get('product.uom')
+    product_obj = pool.get('product.product')
+
+    currency_id = currency_obj.create({
+        'name': 'Euro',
+        'symbol': 'EUR',
+        'code': 'EUR',
+    })
+    company_id = company_obj.create({
+        'name': 'Contract Company',
+        'currency': currency_id,
+    })
+    user_obj.write(USER, {
+        'main_company': company_id,
+        'company': company_id,
+    })
+
+    with Transaction().set_context(company=company_id):
+        type_id = account_type_obj.create({
+            'name': 'Contract',
+            'sequence': 10,
+            'display_balance': 'debit-credit',
+            'company': company_id,
+        })
+        receivable_id = account_obj.create({
+            'name': 'Receivable',
+            'kind': 'receivable',
+            'type': type_id,
+            'reconcile': True,
+            'company': company_id,
+        })
+        revenue_id = account_obj.create({
+            'name': 'Revenue',
+            'kind': 'revenue',
+            'type': type_id,
+            'company': company_id,
+        })
+        tax_account_id = account_obj.create({
+            'name': 'Tax',
+            'kind': 'other',
+            'type': type_id,
+            'company': company_id,
+        })
+
+        move_sequence_id = sequence_obj.create({
+            'name': 'Move',
+            'code': 'account.move',
+            'company': company_id,
+        })
+        invoice_sequences = {}
+        for name in ('out_invoice_sequence', 'in_invoice_sequence',
+                'out_credit_note_sequence', 'in_credit_note_sequence'):
+            invoice_sequences[name] = sequence_strict_obj.create({
+                'name': name,
+                'code': 'account.invoice',
+                'company': company_id,
+            })
+        fiscalyear_values = {
+            'name': str(today.year),
+            'start_date': datetime.date(today.year - 1, 1, 1),
+            'end_date': datetime.date(today.year + 1, 12, 31),
+            'post_move_sequence': move_sequence_id,
+            'company': company_id,
+        }
+        fiscalyear_values.update(invoice_sequences)
+        fiscalyear_id = fiscalyear_obj.create(fiscalyear_values)
+        fiscalyear_obj.create_period([fiscalyear_id])
+
+        tax_ids = []
+        for name, percentage in (('VAT', '0.19'), ('Reduced VAT', '0.06')):
+            tax_ids.append(tax_obj.create({
+                'name': name,
+                'description': name,
+                'type': 'percentage',
+                'percentage': Decimal(percentage),
+                'invoice_account': tax_account_id,
+                'credit_note_account': tax_account_id,
+                'company': company_id,
+            }))
+        tax_rule_ids = [
+            tax_rule_obj.create({
+                'name': 'Reduced',
+                'company': company_id,
+                'lines': [('create', {
+                    'origin_tax': tax_ids[0],
+                    'tax': tax_ids[1],
+                })],
+            }),
+            tax_rule_obj.create({
+                'name': 'Exempt',
+                'company': company_id,
+                'lines': [('create', {
+                    'origin_tax': tax_ids[0],
+                })],
+            }),
+        ]
+
+        payment_term_id = payment_term_obj.create({
+            'name': 'Direct',
+            'lines': [('create', {
+                'type': 'remainder',
+                'delay': 'net_days',
+                'days': 0,
+            })],
+        })
+
+        category_id = category_obj.create({'name': 'Subscriptions'})
+        uom_id = uom_obj.search([('name', '=', 'Unit')], limit=1)[0]
+        product_ids = []
+        for i in range(products):
+            # account_revenue and customer_taxes come from account_product
+            product_ids.append(product_obj.create({
+                'name': 'Subscription %d' % i,
+                'type': 'service',
+                'category': category_id,
+                'default_uom': uom_id,
+                'list_price': Decimal(5 * (i + 1)),
+                'cost_price': Decimal('0.0'),
+                'cost_price_method': 'fixed',
+                'account_revenue': revenue_id,
+                'customer_taxes': [('set', [tax_ids[0]])],
+            }))
+
+        journal_id = journal_obj.search([('type', '=', 'revenue')],
+                                        limit=1)[0]
+
+    return {
+        'company': company_id,
+        'journal': journal_id,
+        'payment_term': payment_term_id,
+        'receivable': receivable_id,
+        'products': product_ids,
+        'tax_rules': tax_rule_ids,
+    }
+
+
+def generate_contracts(fixture, parties, contracts, today=None, seed=0):
+    """
+    Create parties and contracts spread over them, all activated.
+
+    The contracts get a random mix of intervals, start dates in the two
+    years before today, list price overrides, discounts and stop dates,
+    and the parties a random customer tax rule. The same seed yields the
+    same data set.
+
+    returns the list of contract ids
+    """
+    today = today or datetime.date.today()
+    pool = Pool(Transaction().cursor.database_name)
+    party_obj = pool.get('party.party')
+    contract_obj = pool.get('contract.contract')
+    rand = random.Random(seed)
+
+    with Transaction().set_context(company=fixture['company']):
+        party_ids = []
+        for i in range(parties):
+            party_ids.append(party_obj.create({
+                'name': 'Customer %d' % i,
+                'addresses': [('create', {'name': 'Customer %d' % i})],
+                'account_receivable': fixture['receivable'],
+                'customer_tax_rule': rand.choice(
+                    fixture['tax_rules'] + [False, False]),
+            }))
+
+        contract_ids = []
+        for i in range(contracts):
+            interval, interval_quant = rand.choice(INTERVALS)
+            start_date = today - datetime.timedelta(rand.randint(0, 730))
+            stop_date = False
+            if rand.random() < 0.1:
+                stop_date = start_date + datetime.timedelta(
+                    rand.randint(30, 1095))
+            list_price = Decimal('0.0')
+            if rand.random() < 0.2:
+                list_price = Decimal(rand.randint(1, 100))
+            contract_ids.append(contract_obj.create({
+                'name': 'Contract %d' % i,
+                'company': fixture['company'],
+                'journal': fixture['journal'],
+                'payment_term': fixture['payment_term'],
+                'party': party_ids[i % parties],
+                'product': rand.choice(fixture['products']),
+                'list_price': list_price,
+                'discount': Decimal(rand.choice(DISCOUNTS)),
+                'quantity': Decimal(rand.randint(1, 3)),
+                'interval': interval,
+                'interval_quant': interval_quant,
+                'start_date': start_date,
+                'stop_date': stop_date,
+            }))
+        contract_obj.workflow_trigger_validate(contract_ids, 'active')
+    return contract_ids
@@ -0,0 +1,249 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from __future__ import with_statement
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.wizard import Wizard
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+# contract state set by each activity of the contract workflow
+ACTIVITY_STATES = {
+    'draft': 'draft',
+    'active': 'active',
+    'hold': 'hold',
+    'cancel': 'canceled',
+}
+
+SIGNALS = [
+    ('active', 'Activate'),
+    ('hold', 'Hold'),
+    ('cancel', 'Cancel'),
+    ('draft', 'Draft'),
+]
+
+
+class Contract(ModelSQL, ModelView):
+    _name = 'contract.contract'
+
+    def __init__(self):
+        super(Contract, self).__init__()
+        self._rpc.update({
+            'bulk_transition': True,
+        })
+
+    def _signal_transitions(self, signal):
+        """
+        returns a dict mapping the id of each activity of the contract
+        workflow that has a transition on signal to the (transition
+        destination activity id, group id, condition) tuple
+        """
+        workflow_obj = self.pool.get('workflow')
+        activity_obj = self.pool.get('workflow.activity')
+        transition_obj = self.pool.get('workflow.transition')
+
+        with Transaction().set_user(0):
+            workflow_ids = workflow_obj.search([('model', '=', self._name)])
+            activity_ids = activity_obj.search([
+                ('workflow', 'in', workflow_ids),
+            ])
+            transition_ids = transition_obj.search([
+                ('act_from', 'in', activity_ids),
+                ('signal', '=', signal),
+            ])
+            transitions = transition_obj.read(transition_ids,
+                ['act_from', 'act_to', 'group', 'condition'])
+        res = {}
+        for transition in transitions:
+            res[transition['act_from']] = (transition['act_to'],
+                transition['group'], transition['condition'])
+        return res
+
+    def bulk_transition(self, ids, signal):
+        """
+        Send signal to the workflow of the contracts in ids at once.
+
+        The current activity of all contracts is read with one query per
+        IN_MAX contracts and checked against the transitions of the
+        workflow on signal and their group. The allowed transitions are
+        applied with one UPDATE of the workitems and one of the contracts
+        per source activity, which leaves the workflow instances as
+        workflow_trigger_validate would, and the changed contracts are
+        dropped from the cursor cache. The access rights are checked as
+        write does. Transitions with a condition, and all transitions when
+        triggers on write exist for contracts, go through
+        workflow_trigger_validate so the triggers still fire. The billing
+        queue is synced for the changed contracts.
+
+        returns a dict mapping each contract id to its outcome: 'done',
+        'invalid' when signal is not allowed from its state, 'denied' when
+        the user is not in the group of the transition or 'missing' when
+        the contract has no running workflow
+        """
+        cursor = Transaction().cursor
+        user_obj = self.pool.get('res.user')
+        model_access_obj = self.pool.get('ir.model.access')
+        model_field_access_obj = self.pool.get('ir.model.field.access')
+        trigger_obj = self.pool.get('ir.trigger')
+        instance_obj = self.pool.get('workflow.instance')
+        workitem_obj = self.pool.get('workflow.workitem')
+        activity_obj = self.pool.get('workflow.activity')
+        queue_obj = self.pool.get('contract.billing_queue')
+
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        model_access_obj.check(self._name, 'write')
+        model_field_access_obj.check(self._name, ['state'], 'write')
+        transitions = self._signal_transitions(signal)
+        validate = bool(trigger_obj.get_triggers(self._name, 'write'))
+        groups = None
+        if Transaction().user != 0:
+            groups = user_obj.get_groups()
+
+        res = dict([(x, 'missing') for x in ids])
+        by_activity = {}
+        conditional = []
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('i.res_id', sub_ids)
+            cursor.execute('SELECT i.res_id, w.id, w.activity '
+                'FROM "' + instance_obj._table + '" i '
+                'JOIN "' + workitem_obj._table + '" w '
+                    'ON (w.instance = i.id) '
+                'WHERE ' + red_sql + ' AND i.res_type = %s '
+                    'AND i.state = %s AND w.state = %s',
+                red_ids + [self._name, 'active', 'complete'])
+            for contract_id, workitem_id, activity_id in cursor.fetchall():
+                if activity_id not in transitions:
+                    res[contract_id] = 'invalid'
+                    continue
+                act_to, group, condition = transitions[activity_id]
+                if group and groups is not None and group not in groups:
+                    res[contract_id] = 'denied'
+                    continue
+                if condition != 'True' or validate:
+                    conditional.append(contract_id)
+                    continue
+                res[contract_id] = 'done'
+                by_activity.setdefault(activity_id, []).append(
+                    (contract_id, workitem_id))
+
+        activity_names = {}
+        with Transaction().set_user(0):
+            activities = activity_obj.read(list(set([transitions[x][0]
+                for x in by_activity])), ['name'])
+        for activity in activities:
+            activity_names[activity['id']] = activity['name']
+
+        changed = []
+        now = datetime.datetime.now()
+        for activity_id, items in by_activity.items():
+            act_to = transitions[activity_id][0]
+            state = ACTIVITY_STATES[activity_names[act_to]]
+            for i in range(0, len(items), cursor.IN_MAX):
+                sub_items = items[i:i + cursor.IN_MAX]
+                red_sql, red_ids = reduce_ids('id', [x[1] for x in sub_items])
+                cursor.execute('UPDATE "' + workitem_obj._table + '" '
+                    'SET activity = %s, write_uid = %s, write_date = %s '
+                    'WHERE ' + red_sql,
+                    [act_to, Transaction().user, now] + red_ids)
+                contract_ids = [x[0] for x in sub_items]
+                red_sql, red_ids = reduce_ids('id', contract_ids)
+                cursor.execute('UPDATE "' + self._table + '" '
+                    'SET state = %s, write_uid = %s, write_date = %s '
+                    'WHERE ' + red_sql,
+                    [state, Transaction().user, now] + red_ids)
+                changed.extend(contract_ids)
+
+        if changed:
+            self._clear_cursor_cache(changed)
+            # as Contract.write does for a state change
+            self.workflow_trigger_trigger(changed)
+            queue_obj.sync(changed)
+
+        if conditional:
+            before = dict([(x['id'], x['state'])
+                for x in self.read(conditional, ['state'])])
+            self.workflow_trigger_validate(conditional, signal)
+            for contract in self.read(conditional, ['state']):
+                if contract['state'] != before[contract['id']]:
+                    res[contract['id']] = 'done'
+                else:
+                    res[contract['id']] = 'invalid'
+
+        log.info('bulk transition %s on %d contracts: %d done', signal,
+                 len(ids), len([x for x in res.values() if x == 'done']))
+        return res
+
+Contract()
+
+
+class BulkTransitionInit(ModelView):
+    'Contract Bulk Transition'
+    _name = 'contract.contract.bulk_transition.init'
+    _description = __doc__
+    signal = fields.Selection(SIGNALS, 'Action', required=True)
+
+    def default_signal(self):
+        return 'active'
+
+BulkTransitionInit()
+
+
+class BulkTransitionResult(ModelView):
+    'Contract Bulk Transition Result'
+    _name = 'contract.contract.bulk_transition.result'
+    _description = __doc__
+    done = fields.Integer('Done', readonly=True)
+    failed = fields.Integer('Failed', readonly=True)
+    failures = fields.Text('Failures', readonly=True)
+
+BulkTransitionResult()
+
+
+class BulkTransition(Wizard):
+    'Contract Bulk Transition'
+    _name = 'contract.contract.bulk_transition'
+    states = {
+        'init': {
+            'result': {
+                'type': 'form',
+                'object': 'contract.contract.bulk_transition.init',
+                'state': [
+                    ('end', 'Cancel', 'tryton-cancel'),
+                    ('transition', 'Apply', 'tryton-ok', True),
+                ],
+            },
+        },
+        'transition': {
+            'actions': ['_transition'],
+            'result': {
+                'type': 'form',
+                'object': 'contract.contract.bulk_transition.result',
+                'state': [
+                    ('end', 'Close', 'tryton-ok', True),
+                ],
+            },
+        },
+    }
+
+    def _transition(self, data):
+        contract_obj = self.pool.get('contract.contract')
+
+        res = contract_obj.bulk_transition(data['ids'],
+                                           data['form']['signal'])
+        failed = sorted([(x, y) for x, y in res.items() if y != 'done'])
+        names = contract_obj.get_rec_name([x[0] for x in failed],
+                                          'rec_name')
+        return {
+            'done': len(res) - len(failed),
+            'failed': len(failed),
+            'failures': '\n'.join(['%s: %s' % (names[contract_id], outcome)
+                for contract_id, outcome in failed]),
+        }
+
+BulkTransition()
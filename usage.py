@@ -0,0 +1,323 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from decimal import Decimal
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+from trytond.backend import DatabaseIntegrityError
+from contract import STATES, billing_period, add_intervals
+from billing import BillingStats
+
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def closed_period(interval, interval_quant, last_date, end):
+    """
+    returns tuple (next_date, count)
+
+    next_date is the last period boundary on or before end, stepping
+    interval_quant intervals at a time from last_date, and count the
+    number of intervals between last_date and next_date; count is 0 when
+    the first period after last_date is not over at end.
+    """
+    next_date, count = billing_period(interval, interval_quant, last_date,
+                                      end)
+    if next_date > end:
+        count -= interval_quant or 1
+        next_date = add_intervals(interval, last_date, count)
+    return (next_date, count)
+
+
+class Usage(ModelSQL, ModelView):
+    'Contract Usage'
+    _name = 'contract.usage'
+    _description = __doc__
+    _rec_name = 'date'
+
+    contract = fields.Many2One('contract.contract', 'Contract', required=True,
+                               select=1, ondelete='CASCADE')
+    date = fields.Date('Date', required=True, select=1)
+    quantity = fields.Numeric('Quantity', digits=(16, 4), required=True)
+    count = fields.Integer('Records', readonly=True,
+                           help='Number of usage records summed up')
+
+    def __init__(self):
+        super(Usage, self).__init__()
+        self._order.insert(0, ('date', 'DESC'))
+        self._sql_constraints += [
+            ('contract_date_uniq', 'UNIQUE(contract, date)',
+                'There can be only one usage per contract and day!'),
+        ]
+        self._rpc.update({
+            'ingest': True,
+        })
+
+    def default_quantity(self):
+        return Decimal('0.0')
+
+    def default_count(self):
+        return 0
+
+    def ingest(self, records):
+        """
+        Add usage records, an iterable of (contract id, date, quantity)
+        tuples, to the usage of their contract and day. date may be a
+        datetime.
+
+        The records are summed up per contract and day in memory first,
+        then the days already stored are updated and the others inserted
+        with plain SQL, per IN_MAX contracts. Records of unknown contracts
+        are left out. A day inserted meanwhile by a concurrent ingest is
+        updated instead, see _ingest_insert.
+
+        returns a dict with the number of 'records', the number of
+        'updated' and 'inserted' days, the 'unknown' contract ids and the
+        'conflicts': the (contract id, date, quantity) totals of the days
+        a concurrent ingest inserted but this transaction can not see yet,
+        to be ingested again in a new transaction
+        """
+        cursor = Transaction().cursor
+        contract_obj = self.pool.get('contract.contract')
+
+        totals = {}
+        count = 0
+        for contract_id, date, quantity in records:
+            if isinstance(date, datetime.datetime):
+                date = date.date()
+            key = (contract_id, date)
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = [Decimal('0.0'), 0]
+            total[0] += Decimal(str(quantity))
+            total[1] += 1
+            count += 1
+
+        by_contract = {}
+        for contract_id, date in totals:
+            by_contract.setdefault(contract_id, []).append(date)
+        contract_ids = sorted(by_contract)
+
+        res = {
+            'records': count,
+            'updated': 0,
+            'inserted': 0,
+            'unknown': [],
+            'conflicts': [],
+        }
+        now = datetime.datetime.now()
+        user = Transaction().user
+        for i in range(0, len(contract_ids), cursor.IN_MAX):
+            sub_ids = contract_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute('SELECT id FROM "' + contract_obj._table + '" '
+                'WHERE ' + red_sql, red_ids)
+            known = set([x[0] for x in cursor.fetchall()])
+            res['unknown'].extend([x for x in sub_ids if x not in known])
+            sub_ids = [x for x in sub_ids if x in known]
+            if not sub_ids:
+                continue
+
+            dates = set()
+            for contract_id in sub_ids:
+                dates.update(by_contract[contract_id])
+            red_sql, red_ids = reduce_ids('contract', sub_ids)
+            cursor.execute('SELECT id, contract, "date" '
+                'FROM "' + self._table + '" '
+                'WHERE ' + red_sql + ' AND "date" >= %s AND "date" <= %s',
+                red_ids + [min(dates), max(dates)])
+            existing = {}
+            for usage_id, contract_id, date in cursor.fetchall():
+                if isinstance(date, basestring):
+                    date = datetime.date(*[int(x) for x in date.split('-')])
+                existing[(contract_id, date)] = usage_id
+
+            for contract_id in sub_ids:
+                for date in by_contract[contract_id]:
+                    quantity, records_count = totals[(contract_id, date)]
+                    usage_id = existing.get((contract_id, date))
+                    if usage_id:
+                        cursor.execute('UPDATE "' + self._table + '" '
+                            'SET quantity = quantity + %s, '
+                                '"count" = "count" + %s, '
+                                'write_uid = %s, write_date = %s '
+                            'WHERE id = %s',
+                            (quantity, records_count, user, now, usage_id))
+                        res['updated'] += 1
+                        continue
+                    outcome = self._ingest_insert(contract_id, date,
+                        quantity, records_count, now)
+                    if outcome == 'conflict':
+                        res['conflicts'].append((contract_id, date,
+                                                 quantity))
+                    else:
+                        res[outcome] += 1
+
+        if res['unknown']:
+            log.warning('usage of unknown contracts left out: %s',
+                        res['unknown'])
+        if res['conflicts']:
+            log.warning('usage days added by a concurrent transaction: %s',
+                        res['conflicts'])
+        return res
+
+    def _ingest_insert(self, contract_id, date, quantity, records_count,
+            now):
+        """
+        Insert the usage of contract_id at date in a savepoint. When a
+        concurrent ingest inserted it first, the UNIQUE(contract, date)
+        violation is rolled back to the savepoint and the usage is added
+        to that day with an UPDATE instead.
+
+        returns 'inserted', 'updated' or 'conflict' when the day of the
+        concurrent transaction is not visible to this one yet
+        """
+        cursor = Transaction().cursor
+        user = Transaction().user
+        cursor.execute('SAVEPOINT contract_usage')
+        try:
+            cursor.execute('INSERT INTO "' + self._table + '" '
+                '(create_uid, create_date, contract, "date", quantity, '
+                    '"count") '
+                'VALUES (%s, %s, %s, %s, %s, %s)',
+                (user, now, contract_id, date, quantity, records_count))
+        except DatabaseIntegrityError:
+            cursor.execute('ROLLBACK TO SAVEPOINT contract_usage')
+            cursor.execute('RELEASE SAVEPOINT contract_usage')
+            cursor.execute('UPDATE "' + self._table + '" '
+                'SET quantity = quantity + %s, '
+                    '"count" = "count" + %s, '
+                    'write_uid = %s, write_date = %s '
+                'WHERE contract = %s AND "date" = %s',
+                (quantity, records_count, user, now, contract_id, date))
+            if cursor.rowcount:
+                return 'updated'
+            return 'conflict'
+        cursor.execute('RELEASE SAVEPOINT contract_usage')
+        return 'inserted'
+
+    def sum_periods(self, periods):
+        """
+        returns a dict mapping contract id to its usage from the start
+        (included) to the end (excluded) of its period in periods, a dict
+        mapping contract id to (start, end) tuples; _check_contracts moves
+        the end of the last period of a contract past its stop_date
+
+        The contracts sharing a period are summed up with one grouped
+        query per IN_MAX contracts.
+        """
+        cursor = Transaction().cursor
+
+        by_period = {}
+        for contract_id, period in periods.items():
+            by_period.setdefault(period, []).append(contract_id)
+
+        res = dict([(x, Decimal('0.0')) for x in periods])
+        for (start, end), contract_ids in by_period.items():
+            for i in range(0, len(contract_ids), cursor.IN_MAX):
+                sub_ids = contract_ids[i:i + cursor.IN_MAX]
+                red_sql, red_ids = reduce_ids('contract', sub_ids)
+                cursor.execute('SELECT contract, SUM(quantity) '
+                    'FROM "' + self._table + '" '
+                    'WHERE ' + red_sql + ' AND "date" >= %s AND "date" < %s '
+                    'GROUP BY contract', red_ids + [start, end])
+                for contract_id, quantity in cursor.fetchall():
+                    res[contract_id] = Decimal(str(quantity or 0))
+        return res
+
+Usage()
+
+
+class Contract(ModelSQL, ModelView):
+    _name = 'contract.contract'
+
+    metered = fields.Boolean('Metered', states=STATES,
+        help='Bill the recorded usage of each period after it ended, '
+        'instead of the quantity per interval in advance')
+    usages = fields.One2Many('contract.usage', 'contract', 'Usage',
+                             readonly=True)
+
+    def default_metered(self):
+        return False
+
+    def _check_contracts(self, contracts, invoice_date, stats=None):
+        """
+        Metered contracts are due once a period is over: the period runs
+        from next_invoice_date (or start_date) to the last boundary on or
+        before invoice_date, or to stop_date when it falls before, and its
+        quantity is the usage recorded in it. The end of a period is the
+        start of the next one and its usage belongs there, except for the
+        last period: the usage of stop_date itself is billed with it. The
+        other contracts are checked as before.
+        """
+        usage_obj = self.pool.get('contract.usage')
+        if stats is None:
+            stats = BillingStats()
+
+        metered = [x for x in contracts if x.metered]
+        if not metered:
+            return super(Contract, self)._check_contracts(contracts,
+                invoice_date, stats=stats)
+        res = super(Contract, self)._check_contracts([x for x in contracts
+            if not x.metered], invoice_date, stats=stats)
+
+        periods = {}
+        usage_periods = {}
+        for contract in metered:
+            res[contract.id] = False
+            if not contract.state == 'active':
+                stats.skip('inactive')
+                continue
+
+            last_date = contract.next_invoice_date or contract.start_date \
+                    or invoice_date
+            end = invoice_date
+            if contract.stop_date and contract.stop_date < end:
+                end = contract.stop_date
+            if last_date >= end:
+                stats.skip(end < invoice_date and 'stopped' or 'too_early')
+                continue
+
+            next_date, quant = closed_period(contract.interval,
+                contract.interval_quant, last_date, end)
+            if end == contract.stop_date:
+                next_date = end
+            elif not quant:
+                log.debug('period of metered contract %s not over at %s',
+                          contract.id, invoice_date)
+                stats.skip('too_early')
+                continue
+            periods[contract.id] = (last_date, next_date)
+            if next_date == contract.stop_date:
+                usage_periods[contract.id] = (last_date,
+                    next_date + datetime.timedelta(1))
+            else:
+                usage_periods[contract.id] = (last_date, next_date)
+
+        quantities = usage_obj.sum_periods(usage_periods)
+        for contract_id, (last_date, next_date) in periods.items():
+            res[contract_id] = (last_date, next_date,
+                                quantities[contract_id])
+        return res
+
+    def _due_domain(self, invoice_date):
+        """
+        Metered contracts are billed in arrears, up to and including their
+        stop_date: the active metered contracts whose next_invoice_date is
+        unset or before invoice_date are selected too, whatever their
+        stop_date.
+        """
+        domain = super(Contract, self)._due_domain(invoice_date)
+        return [['OR', domain, [
+            ('metered', '=', True),
+            ('state', '=', 'active'),
+            ('start_date', '<', invoice_date),
+            ['OR',
+                ('next_invoice_date', '=', False),
+                ('next_invoice_date', '<', invoice_date),
+            ],
+        ]]]
+
+Contract()